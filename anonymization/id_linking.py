@@ -15,7 +15,7 @@ def get_real_ID(dummy_ID, shift_pattern):
     real_ID = list(dummy_ID);
 
     c = 0;
-    for k in range(0, len(dummy_ID)): ## TODO 20180607 If len(dummy_ID) is longer than len(shift_pattern) the code will break.
+    for k in range(0, len(dummy_ID)):
         digit = int(dummy_ID[k])
         shift = int(shift_pattern[c])
         if digit < shift:
@@ -26,7 +26,7 @@ def get_real_ID(dummy_ID, shift_pattern):
 
         real_ID[k] = str(dummy);
         c += 1;
-        if c > len(shift_pattern):
+        if c >= len(shift_pattern):
             c = 0;
     
     return "".join(real_ID)
@@ -55,10 +55,103 @@ def get_fake_ID(real_ID, shift_pattern):
             
         dummy_ID[k] = str(dummy);
         c += 1;
-        if c > len(shift_pattern):
+        if c >= len(shift_pattern):
             c = 0;
         
     return "".join(dummy_ID)
+
+def expand_pattern(shift_pattern, length):
+    ''' Repeat a shift pattern to a given length, as an array of digits.
+
+        :param shift_pattern: A numeric shift pattern.
+        :type shift_pattern: str
+        :param length: Number of digits needed, i.e. the length of the longest ID.
+        :type length: int
+        :returns: A numpy.ndarray of int8 of the given length.
+    '''
+    import numpy as np
+
+    if not shift_pattern.isdigit():
+        raise ValueError("shift_pattern is not numeric")
+    pattern = np.frombuffer(shift_pattern.encode('ascii'), dtype = np.uint8).astype(np.int8) - ord('0')
+    return np.resize(pattern, length)
+
+def shift_IDs(IDs, shift_pattern, reverse = False, errors = 'raise'):
+    ''' Shift many numeric IDs at once, as get_fake_ID (or get_real_ID if reverse) does for one.
+
+        :param IDs: Numeric IDs, e.g. a column of accession numbers. Integers
+            lose their leading zeros, so read IDs as strings (e.g. dtype = str in pandas.read_csv).
+        :type IDs: numpy.ndarray, pandas.Series or list of str
+        :param shift_pattern: A shift pattern to perform the digit shifting.
+        :type shift_pattern: str
+        :param reverse: Shift back a dummy ID into the real ID.
+        :type reverse: boolean
+        :param errors: 'raise' to raise ValueError on a non-numeric ID, 'blank' to return '' for it.
+        :type errors: str
+        :returns: The shifted IDs, as a pandas.Series with the index of IDs if IDs is one, else a numpy.ndarray of str.
+    '''
+    import numpy as np
+
+    if errors not in ('raise', 'blank'):
+        raise ValueError("errors must be 'raise' or 'blank'")
+    values = getattr(IDs, 'values', IDs)
+    ids = np.asarray(values)
+    if ids.dtype.kind != 'S':
+        ids = ids.astype('S')
+    width = max(ids.dtype.itemsize, 1)
+    # one row of ascii codes per ID, padded with 0 after the last digit
+    digits = np.ascontiguousarray(ids).view(np.uint8).reshape(len(ids), width)
+    padding = digits == 0
+    valid = (((digits >= ord('0')) & (digits <= ord('9'))) | padding).all(axis = 1) & ~padding[:, 0]
+    if not valid.all():
+        if errors == 'raise':
+            raise ValueError("%s is not numeric" % ids[~valid][0])
+        digits = np.where(valid[:, np.newaxis], digits, 0)
+        padding = digits == 0
+
+    shift = expand_pattern(shift_pattern, width)
+    if reverse:
+        shift = 10 - shift
+    shifted = (digits - ord('0') + shift) % 10 + ord('0')
+    shifted = np.where(padding, 0, shifted).astype(np.uint8)
+    result = shifted.view('S%d' % width).ravel()
+
+    if hasattr(IDs, 'index') and hasattr(IDs, 'values'):
+        import pandas as pd
+        return pd.Series(result, index = IDs.index, name = IDs.name)
+    return result
+
+def shift_csv_column(input_csv, output_csv, column, shift_pattern, reverse = False, new_column = None, chunksize = 1000000):
+    ''' Add the shifted IDs of a column to a csv file, a chunk at a time.
+
+        IDs that are missing or not numeric get an empty value.
+
+        :param input_csv: An input csv file with a header.
+        :type input_csv: str
+        :param output_csv: The output csv file.
+        :type output_csv: str
+        :param column: The column of IDs to shift.
+        :type column: str
+        :param shift_pattern: A shift pattern to perform the digit shifting.
+        :type shift_pattern: str
+        :param reverse: Shift back dummy IDs into the real IDs.
+        :type reverse: boolean
+        :param new_column: The column to write the shifted IDs to. Default: column + '_real' if reverse, else column + '_dummy'.
+        :type new_column: str
+        :param chunksize: Number of rows read at a time.
+        :type chunksize: int
+        :returns: Number of rows written.
+    '''
+    import pandas as pd
+
+    if new_column is None:
+        new_column = column + ('_real' if reverse else '_dummy')
+    num_rows = 0
+    for chunk in pd.read_csv(input_csv, dtype = str, keep_default_na = False, chunksize = chunksize):
+        chunk[new_column] = shift_IDs(chunk[column], shift_pattern, reverse = reverse, errors = 'blank')
+        chunk.to_csv(output_csv, mode = 'w' if num_rows == 0 else 'a', header = num_rows == 0, index = False)
+        num_rows += len(chunk)
+    return num_rows
     
 def main():
     ''' This main function is rarely used. '''
@@ -69,14 +162,13 @@ def main():
     pattern = sys.argv[2]
     pattern = pattern.strip()
     with open(input_csv, 'rb') as f:
-        for line in f:
-            line = line.strip()
-            try:
-                real_id = get_real_ID(line, pattern)
-                print line + ',' + real_id
-            except:
-                print sys.exc_info()[0]
-                continue
+        lines = [line.strip() for line in f]
+    real_ids = shift_IDs(lines, pattern, reverse = True, errors = 'blank')
+    for line, real_id in zip(lines, real_ids):
+        if real_id:
+            print line + ',' + real_id
+        else:
+            print ValueError
                 
             
 if __name__ == '__main__': 
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+
+import csv, struct
+import shutil
+
+## Redaction rules: rectangles of burned-in annotations to black out, by
+## (Manufacturer, ManufacturerModelName, Rows, Columns). Rectangles are in
+## pixels, top and left inclusive, bottom and right exclusive, and are
+## applied to every frame and sample. Redacted pixels are set to 0, which is
+## black except for MONOCHROME1.
+
+_long_length_VRs = ('OB', 'OW', 'OF', 'SQ', 'UT', 'UN')
+_pixel_data_tag = (0x7FE0, 0x0010)
+_sequence_delimiter = (0xFFFE, 0xE0DD)
+
+def load_redaction_rules(rules_file):
+    ''' Load a redaction rules table like pixel_redaction_rules.csv.
+
+        :param rules_file: A csv file with Manufacturer, ManufacturerModelName,
+            Rows, Columns, Top, Left, Bottom and Right columns, one rectangle per row.
+        :type rules_file: str
+        :returns: A dict of (Manufacturer, ManufacturerModelName, Rows, Columns)
+            to a list of (top, left, bottom, right).
+    '''
+    rules = {}
+    with open(rules_file, 'rb') as f:
+        for row in csv.DictReader(f):
+            try:
+                key = (row['Manufacturer'].strip(), row['ManufacturerModelName'].strip(),
+                       int(row['Rows']), int(row['Columns']))
+                rect = tuple(int(row[k]) for k in ['Top', 'Left', 'Bottom', 'Right'])
+            except (TypeError, ValueError):
+                # blank lines
+                continue
+            rules.setdefault(key, []).append(rect)
+    return rules
+
+def find_redactions(ds, rules):
+    ''' Return the rectangles to redact in a dicom.
+
+        :param ds: The header of the dicom, before anonymization.
+        :type ds: dicom.dataset.Dataset
+        :param rules: Rules from load_redaction_rules.
+        :type rules: dict
+        :returns: A list of (top, left, bottom, right), empty if no rule matches.
+    '''
+    if not rules or 'Rows' not in ds or 'Columns' not in ds:
+        return []
+    key = (str(getattr(ds, 'Manufacturer', '')).strip(), str(getattr(ds, 'ManufacturerModelName', '')).strip(),
+           int(ds.Rows), int(ds.Columns))
+    return rules.get(key, [])
+
+def _pixel_rows(ds):
+    ''' Return the layout of native pixel data as a stack of rows: the number
+        of rows (of all frames and planes), the bytes per row, the rows per
+        image and the bytes per pixel along a row.
+    '''
+    bits = int(ds.BitsAllocated)
+    if bits % 8:
+        raise ValueError('Cannot redact pixel data of %d bits allocated.' % bits)
+    photometric = str(getattr(ds, 'PhotometricInterpretation', ''))
+    if photometric.endswith('_422') or photometric.endswith('_420'):
+        raise ValueError('Cannot redact subsampled %s pixel data.' % photometric)
+    frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+    samples = int(getattr(ds, 'SamplesPerPixel', 1))
+    rows, columns = int(ds.Rows), int(ds.Columns)
+    if samples > 1 and int(getattr(ds, 'PlanarConfiguration', 0)) == 1:
+        pixel_bytes = bits / 8
+        planes = samples
+    else:
+        pixel_bytes = samples * bits / 8
+        planes = 1
+    return frames * planes * rows, columns * pixel_bytes, rows, pixel_bytes
+
+def redact_rows(pixels, first_row, rows, rects, pixel_bytes):
+    ''' Set rectangles of a run of pixel rows to 0 in place.
+
+        :param pixels: Rows first_row, first_row + 1, ... of the stack of rows
+            of _pixel_rows, as an array of uint8 of shape (rows in the run, bytes per row).
+        :type pixels: numpy.ndarray
+        :param first_row: Index of the first row of pixels in the stack.
+        :type first_row: int
+        :param rows: Rows per image.
+        :type rows: int
+        :param rects: Rectangles (top, left, bottom, right) in pixels.
+        :type rects: list
+        :param pixel_bytes: Bytes per pixel along a row.
+        :type pixel_bytes: int
+    '''
+    import numpy as np
+
+    image_rows = (first_row + np.arange(len(pixels))) % rows
+    for top, left, bottom, right in rects:
+        selected = (image_rows >= top) & (image_rows < bottom)
+        if selected.any():
+            pixels[selected, left * pixel_bytes:right * pixel_bytes] = 0
+
+def _element_header(head, ds):
+    ''' Parse the header of a data element.
+
+        :param head: The first 12 bytes of the element (8 for implicit VR).
+        :type head: str
+        :param ds: The header of the file.
+        :type ds: dicom.dataset.Dataset
+        :returns: A tuple of ((group, element), header length, value length).
+    '''
+    endian = '<' if ds.is_little_endian else '>'
+    tag = struct.unpack(endian + 'HH', head[:4])
+    if ds.is_implicit_VR:
+        return tag, 8, struct.unpack(endian + 'L', head[4:8])[0]
+    elif head[4:6] in _long_length_VRs:
+        return tag, 12, struct.unpack(endian + 'L', head[8:12])[0]
+    return tag, 8, struct.unpack(endian + 'H', head[6:8])[0]
+
+def pixel_data_end(fp, offset, ds):
+    ''' Return the offset past the pixel data element at offset in fp.
+
+        The fragments of encapsulated pixel data are skipped by their item
+        headers, without reading them.
+
+        :param fp: A dicom file, opened in binary mode.
+        :type fp: file
+        :param offset: Offset of the pixel data element, see read_dicom_header.read_header.
+        :type offset: int
+        :param ds: The header of fp.
+        :type ds: dicom.dataset.Dataset
+        :returns: The offset, or None if the element at offset is not the pixel
+            data (or there is none).
+    '''
+    fp.seek(offset)
+    head = fp.read(12)
+    if len(head) < 8:
+        return None
+    tag, head_length, length = _element_header(head, ds)
+    if tag != _pixel_data_tag:
+        return None
+    end = offset + head_length
+    if length != 0xFFFFFFFF:
+        return end + length
+    endian = '<' if ds.is_little_endian else '>'
+    while True:
+        fp.seek(end)
+        item = fp.read(8)
+        if len(item) < 8:
+            # truncated
+            return end
+        group, element, length = struct.unpack(endian + 'HHL', item)
+        end += 8
+        if (group, element) == _sequence_delimiter:
+            return end
+        end += length
+
+def copy_redacted(fsrc, fdst, offset, ds, rects, buffer_size = 1024*1024):
+    ''' Copy the pixel data element of fsrc, and the bytes after it, to fdst
+        with rectangles blacked out.
+
+        The pixel data is read into one buffer of whole rows at a time and
+        redacted there, through a numpy view of the buffer, before it is
+        written, so it is neither held in memory entirely nor copied twice.
+
+        :param fsrc: The source dicom, opened in binary mode.
+        :type fsrc: file
+        :param fdst: The output, positioned after the header.
+        :type fdst: file
+        :param offset: Offset of the pixel data element in fsrc.
+        :type offset: int
+        :param ds: The header of fsrc.
+        :type ds: dicom.dataset.Dataset
+        :param rects: Rectangles (top, left, bottom, right) in pixels.
+        :type rects: list
+        :param buffer_size: Bytes read at a time.
+        :type buffer_size: int
+    '''
+    import numpy as np
+
+    fsrc.seek(offset)
+    head = fsrc.read(12)
+    if len(head) < 12:
+        # no pixel data
+        fdst.write(head)
+        return
+    tag, head_length, length = _element_header(head, ds)
+    if length == 0xFFFFFFFF:
+        raise ValueError('Cannot redact compressed (encapsulated) pixel data.')
+    num_rows, row_bytes, rows, pixel_bytes = _pixel_rows(ds)
+    if num_rows * row_bytes > length:
+        raise ValueError('Pixel data of %d bytes is smaller than its dimensions.' % length)
+
+    fdst.write(head[:head_length])
+    fsrc.seek(offset + head_length)
+    chunk_rows = max(1, buffer_size // row_bytes)
+    buf = bytearray(chunk_rows * row_bytes)
+    view = memoryview(buf)
+    row = 0
+    while row < num_rows:
+        n = min(chunk_rows, num_rows - row)
+        if fsrc.readinto(view[:n * row_bytes]) != n * row_bytes:
+            raise ValueError('Pixel data is truncated.')
+        pixels = np.frombuffer(buf, dtype = np.uint8, count = n * row_bytes).reshape(n, row_bytes)
+        redact_rows(pixels, row, rows, rects, pixel_bytes)
+        fdst.write(view[:n * row_bytes])
+        row += n
+    # padding, if any; read_for_rewrite reads dicoms with elements after the
+    # pixel data entirely, so they never get here
+    shutil.copyfileobj(fsrc, fdst, buffer_size)
+
+def redact_dataset(ds, rects):
+    ''' Redact the native pixel data of a dataset read entirely, in place.
+
+        :param ds: A dataset with its pixel data.
+        :type ds: dicom.dataset.Dataset
+        :param rects: Rectangles (top, left, bottom, right) in pixels.
+        :type rects: list
+    '''
+    import numpy as np
+
+    if 'PixelData' not in ds:
+        return
+    if ds.data_element('PixelData').is_undefined_length:
+        raise ValueError('Cannot redact compressed (encapsulated) pixel data.')
+    num_rows, row_bytes, rows, pixel_bytes = _pixel_rows(ds)
+    buf = bytearray(ds.PixelData)
+    if num_rows * row_bytes > len(buf):
+        raise ValueError('Pixel data of %d bytes is smaller than its dimensions.' % len(buf))
+    pixels = np.frombuffer(buf, dtype = np.uint8, count = num_rows * row_bytes).reshape(num_rows, row_bytes)
+    redact_rows(pixels, 0, rows, rects, pixel_bytes)
+    ds.PixelData = bytes(buf)
@@ -4,12 +4,21 @@ __EXEC__ = __file__
 
 # Import modules here
 import os, sys, csv, lockfile, dicom
-from glob import glob
+import shutil
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict
 import traceback as tb
 import logging as log
-from pandas import read_csv
 
 import id_linking as il
+import uid_remapping as ur
+import pixel_redaction as pr
+
+## shared helpers in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from discover_dicom import discover_dicom
+from read_dicom_header import read_header, parse_tag
     
 ## Create a logger
 try:  # Python 2.7+
@@ -35,64 +44,359 @@ logger.addHandler(ch)
 ## Basic Application Level Confidentiality Profile Attributes
 ## Annex E, E1 ftp://medical.nema.org/medical/dicom/2008/08_15pu.pdf
 
+_remove, _replace, _replace_date = _actions = ('Remove', 'Replace', 'ReplaceDate')
+
+def _default_tag_cache(tag_file):
+    ''' Return the default cache of a tag table, in the user cache directory
+        ($XDG_CACHE_HOME or ~/.cache) rather than next to the (possibly
+        read-only) table, named after the table and its path.
+    '''
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    tag_file = os.path.abspath(tag_file)
+    name = '%s.%s.cache' % (os.path.basename(tag_file), hashlib.sha1(tag_file).hexdigest()[:12])
+    return os.path.join(cache_dir, 'dicom_manipulation', name)
+
+def compile_tag_table(tag_file, cache = None):
+    ''' Compile a tag table like dicom_anon_tags.csv into a map of tag to action.
+
+        Tags to keep are left out. The map is pickled to cache and loaded from
+        there as long as the size and modification time of tag_file match.
+
+        :param tag_file: A csv file with Tag (hex) and AnonymizedByCBIG (Keep, Remove, Replace or ReplaceDate) columns.
+        :type tag_file: str
+        :param cache: Path to the compiled table. Default: in the user cache directory, see _default_tag_cache.
+        :type cache: str
+        :returns: An OrderedDict of tag (int) to action, in the order of tag_file.
+    '''
+    if cache is None:
+        cache = _default_tag_cache(tag_file)
+    st = os.stat(tag_file)
+    stamp = (st.st_size, st.st_mtime)
+    try:
+        with open(cache, 'rb') as f:
+            cached_stamp, actions = pickle.load(f)
+        if cached_stamp == stamp:
+            return actions
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    actions = OrderedDict()
+    with open(tag_file, 'rb') as f:
+        for row in csv.DictReader(f):
+            try:
+                tag = _int_from_hex(row['Tag'])
+            except (TypeError, ValueError):
+                # blank lines and the source in the footer
+                continue
+            if row['AnonymizedByCBIG'] in _actions:
+                actions[tag] = row['AnonymizedByCBIG']
+
+    # write then rename, so that concurrent runs never load a partial cache
+    cache_tmp = '%s.%d' % (cache, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(cache)):
+            os.makedirs(os.path.dirname(cache))
+        with open(cache_tmp, 'wb') as f:
+            pickle.dump((stamp, actions), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_tmp, cache)
+    except (IOError, OSError):
+        logger.debug('Cannot cache the tag table in %s' % cache)
+    return actions
+
 _source_dir, _ = os.path.split(__file__)
 _dicom_tag_file = os.path.join(_source_dir, 'dicom_anon_tags.csv')
-_df = read_csv(_dicom_tag_file, converters = {'Tag': _int_from_hex}, engine='python', skipfooter = 2)
+_tag_actions = compile_tag_table(_dicom_tag_file)
 
-_fields_subject_to_anonymize=[]
-_fields_subject_to_anonymize_string=[]
-for c in ['Remove', 'Replace', 'ReplaceDate']:
-    _condition = 'AnonymizedByCBIG in "%s"' % c
-    _fields = _df.query(_condition)['Tag'].values
-    _fields_in_string = [hex(i).strip('L') for i in _fields]
-    _fields_subject_to_anonymize.append(_fields)
-    _fields_subject_to_anonymize_string.append(_fields_in_string)
+_fields_subject_to_anonymize = [[t for t, a in _tag_actions.iteritems() if a == c] for c in _actions]
+_fields_subject_to_anonymize_string = [[hex(i).strip('L') for i in _fields] for _fields in _fields_subject_to_anonymize]
 
 _fields_to_remove, _fields_to_replace, _fields_to_replace_date = _fields_subject_to_anonymize
 
 _fields_to_remove_string, _fields_to_replace_string, _fields_to_replace_date_string = _fields_subject_to_anonymize_string
 
+_redaction_rules_file = os.path.join(_source_dir, 'pixel_redaction_rules.csv')
+
+## DeidentificationMethod written to every anonymized dicom, see is_anonymized.
+_deidentification_method = 'CBIG remove_dicom_fields.py'
+
 ## Read CBIG shift pattern
 _pattern_file = _dicom_tag_file = os.path.join(_source_dir, 'sample_anonpattern.cfg')
 with open(_pattern_file, 'r') as _fid:
     _shift_pattern = _fid.readline().strip('\n')
-    _date_shift_pattern = _fid.readline()
+    _date_shift_pattern = _fid.readline().strip('\n')
     
-def discover_files(input_dir, recursive = False):
-    ''' Return a list of files found in a given directory.
+def discover_files(input_dir, recursive = False, force = False):
+    ''' Return a list of dicom files found in a given directory.
     
+        Hidden files and directories are ignored, and files without the DICM
+        marker are skipped without being parsed (see discover_dicom.py).
+
         :param input_dir: An input directory to discover dicom files.
         :type input_dir: str
         :param recursive: A switch to perform the operation recursively. It might be time-consuming.
         :type recursive: boolean
-        :returns: A list of files found in input_dir.
+        :param force: Also return files without the 128-byte preamble and DICM marker.
+        :type force: boolean
+        :returns: A list of dicom files found in input_dir.
     '''
     input_dir = os.path.abspath(input_dir)
-    if recursive:
-        src_files = []
-        for dirpath, dirnames, filenames in os.walk(input_dir):
-            # ignore hidden files and directories
-            filenames = [f for f in filenames if not f[0] == '.']
-            dirnames[:] = [d for d in dirnames if not d[0] == '.']
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                src_files.append(filepath)
+    return list(discover_dicom(input_dir, recursive = recursive, force = force))
+
+_deflated = '1.2.840.10008.1.2.1.99'
+_copy_buffer_size = 1024*1024
+
+def read_for_rewrite(fname, force = False):
+    ''' Read the header of a dicom for anonymize_fields, leaving the pixel data in the file.
+
+        :param fname: Path to a dicom file.
+        :type fname: str
+        :param force: Read the file even if the DICM header is missing.
+        :type force: boolean
+        :returns: A tuple of (dicom.dataset.FileDataset, offset of the pixel data
+            element in fname). The offset is None for a deflated dicom, or one
+            with elements after the pixel data (e.g. private groups or digital
+            signatures), which is read entirely so that every element is
+            anonymized.
+    '''
+    with open(fname, 'rb') as fp:
+        ds = read_header(fp, defer_size = None, force = force)
+        if ds.file_meta.get('TransferSyntaxUID', None) != _deflated:
+            # read_header stops at the start of the pixel data element
+            offset = fp.tell()
+            end = pr.pixel_data_end(fp, offset, ds)
+            # a few bytes of padding are no element
+            if os.fstat(fp.fileno()).st_size - (offset if end is None else end) < 8:
+                return ds, offset
+            logger.info('%s has elements after the pixel data, reading it entirely' % fname)
+    return dicom.read_file(fname, force = force), None
+
+def _copy_file_tail(fsrc, fdst, offset):
+    ''' Copy the bytes of fsrc from offset to the end of fdst, without reading them into memory if possible. '''
+    fdst.flush()
+    if hasattr(os, 'sendfile'):
+        count = os.fstat(fsrc.fileno()).st_size - offset
+        while count > 0:
+            sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
     else:
-        src_files = glob(os.path.join(input_dir, '*'))
+        fsrc.seek(offset)
+        shutil.copyfileobj(fsrc, fdst, _copy_buffer_size)
+
+def _get_fadvise():
+    ''' Return (posix_fadvise, POSIX_FADV_WILLNEED): from os on Python 3.3+,
+        else from the C library through ctypes on Linux, else (None, None).
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise, os.POSIX_FADV_WILLNEED
+    if not sys.platform.startswith('linux'):
+        return None, None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        func = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None, None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    func.restype = ctypes.c_int
+    # POSIX_FADV_WILLNEED on Linux
+    return func, 3
 
-    return src_files
+_fadvise, _fadv_willneed = _get_fadvise()
 
-def anonymize_fields(fname, fields_to_remove, fields_to_replace = None, dates_to_replace = None, study_id = None, odir = None):
+def prefetch(fname, offset):
+    ''' Bring the bytes of fname from offset on into the page cache, ahead of
+        their copy by write_with_pixel_data.
 
-    logger.debug('Anonymizing %s' % fname)
+        With posix_fadvise the kernel reads them in the background; without
+        it they are read here and discarded, which still takes the read off
+        the thread that copies them.
+    '''
+    if _fadvise is not None:
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            _fadvise(fd, offset, 0, _fadv_willneed)
+        finally:
+            os.close(fd)
+        return
+    buf = bytearray(_copy_buffer_size)
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        while f.readinto(buf) == len(buf):
+            pass
+
+def write_with_pixel_data(ds, fout, fname, offset, sync = False, redactions = None):
+    ''' Save a header read by read_for_rewrite, followed by the pixel data of fname copied byte for byte.
+
+        The file is written to a hidden temporary file next to fout and
+        renamed to fout once complete, so fout is never partial, and fout
+        can be fname itself.
+
+        :param ds: The (anonymized) header.
+        :type ds: dicom.dataset.FileDataset
+        :param fout: Output file.
+        :type fout: str
+        :param fname: The dicom ds was read from.
+        :type fname: str
+        :param offset: Offset of the pixel data element in fname. None if ds holds the whole dataset.
+        :type offset: int
+        :param sync: Flush the file to disk before renaming it. The directory is not, see sync_dirs.
+        :type sync: boolean
+        :param redactions: Rectangles to black out in the pixel data, see pixel_redaction.find_redactions.
+        :type redactions: list
+    '''
+    head, tail = os.path.split(fout)
+    tmp = os.path.join(head, '.%s.%d.tmp' % (tail, os.getpid()))
+    try:
+        with open(tmp, 'wb') as fo:
+            if redactions and offset is None:
+                pr.redact_dataset(ds, redactions)
+            ds.save_as(fo)
+            if offset is not None:
+                with open(fname, 'rb') as fsrc:
+                    if redactions:
+                        pr.copy_redacted(fsrc, fo, offset, ds, redactions, _copy_buffer_size)
+                    else:
+                        _copy_file_tail(fsrc, fo, offset)
+            if sync:
+                fo.flush()
+                os.fsync(fo.fileno())
+        os.rename(tmp, fout)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def sync_dirs(dirs):
+    ''' Flush directories to disk, making the files renamed into them durable.
+
+        :param dirs: Directories, each synced once.
+        :type dirs: iterable
+    '''
+    for d in set(dirs):
+        fd = os.open(d, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def build_action_map(fields_to_remove, fields_to_replace = None, dates_to_replace = None):
+    ''' Merge the tags to remove, replace and date-shift into one map of tag to action.
+
+        A tag in several lists gets the action of the last one in the order
+        replace, remove, date.
+
+        :param fields_to_remove: DICOM keywords or tags (int or hex string) to blank.
+        :type fields_to_remove: list
+        :param fields_to_replace: Tags whose numeric value is shifted, blanked if not numeric.
+        :type fields_to_replace: list
+        :param dates_to_replace: Tags whose date is shifted.
+        :type dates_to_replace: list
+        :returns: A dict of tag (int) to action.
+    '''
+    actions = {}
+    for action, fields in ((_replace, fields_to_replace), (_remove, fields_to_remove), (_replace_date, dates_to_replace)):
+        for tag in fields or []:
+            actions[parse_tag(tag)] = action
+    return actions
+
+def apply_actions(ds, actions, remove_private = False, remapper = None):
+    ''' Anonymize a dataset in place, in one pass over its elements and those of its sequences.
+
+        Only the elements with an action (or UIDs, with remapper) are
+        converted from their raw value; the others are written back as read.
 
+        :param ds: A dataset.
+        :type ds: dicom.dataset.Dataset
+        :param actions: A map of tag to action, see build_action_map.
+        :type actions: dict
+        :param remove_private: Also delete the private elements.
+        :type remove_private: boolean
+        :param remapper: If given, every UID element is remapped with it, whatever its action.
+        :type remapper: uid_remapping.UIDRemapper
+    '''
+    for tag in ds.keys():
+        if remove_private and tag.is_private:
+            del ds[tag]
+            continue
+
+        VR = ds.get_item(tag).VR
+        if VR is None:
+            # implicit VR and not converted
+            try:
+                VR = dicom.datadict.dictionaryVR(tag)
+            except KeyError:
+                pass
+
+        action = actions.get(tag, None)
+        if remapper is not None and VR == 'UI':
+            elem = ds[tag]
+            if isinstance(elem.value, list):
+                elem.value = [remapper.remap(uid) for uid in elem.value]
+            else:
+                elem.value = remapper.remap(elem.value)
+        elif action is not None:
+            elem = ds[tag]
+            if action == _replace:
+                logger.debug('Tag to replace: %s %s' % (elem.tag, elem.name))
+                if elem.value.isdigit():
+                    elem.value = il.get_fake_ID(elem.value, _shift_pattern)
+                else:
+                    logger.warning('Tag value of %s %s is not numeric thus shifting is not supported. Removing tag value instead.' % (elem.tag, elem.name))
+                    elem.value = ''
+            elif action == _remove:
+                logger.debug('Tag to remove: %s %s' % (elem.tag, elem.name))
+                elem.value = ''
+            else:
+                logger.debug('Date to replace: %s %s' % (elem.tag, elem.name))
+                if elem.value.isdigit():
+                    elem.value = il.get_fake_ID(elem.value, _date_shift_pattern)
+                else:
+                    if elem.value:
+                        logger.warning('Tag value of %s %s is not a numeric date thus shifting is not supported. Removing tag value instead.' % (elem.tag, elem.name))
+                    elem.value = ''
+
+        if VR == 'SQ':
+            for item in ds[tag].value:
+                apply_actions(item, actions, remove_private = remove_private, remapper = remapper)
+
+def is_anonymized(ds):
+    ''' Check whether a dicom was anonymized by anonymize_dataset already.
+
+        Anonymizing it again would shift its IDs and dates a second time and
+        add a dummy to dummy row to idLookup.csv, e.g. when --in_place is
+        rerun over files replaced before a crash, so in place such files are
+        skipped. Written to another directory, the input is left as it is, so
+        they are anonymized as any other file.
+    '''
+    return _deidentification_method in str(ds.get('DeidentificationMethod', ''))
+
+def anonymized_path(fname, odir, dummy_id):
+    ''' Return the output file of fname, odir/<dummy ID>/<file name>. '''
+    return os.path.join(odir, dummy_id, os.path.basename(fname))
+
+def anonymize_dataset(ds, fname, odir, fields_to_remove = None, fields_to_replace = None, dates_to_replace = None, study_id = None, lookup = None, actions = None, remove_private = False, uid_key = None, in_place = False):
+    ''' Anonymize the header of a dicom in place and return where to save it.
+
+        :param ds: The header of fname, see read_for_rewrite.
+        :type ds: dicom.dataset.FileDataset
+        :param fname: The dicom ds was read from.
+        :type fname: str
+        :param odir: The output directory.
+        :type odir: str
+        :param uid_key: If given, remap every UID with this key (see uid_remapping.py).
+        :type uid_key: str
+        :param in_place: Return fname as the output file.
+        :type in_place: boolean
+        :returns: The output file, odir/<dummy ID>/<file name> or fname if in_place.
+    '''
     csvout = os.path.join(odir, 'idLookup.csv')
 
     head, tail = os.path.split(fname)
     _, dir_id = os.path.split(head)
 
-    ds = dicom.read_file(fname)
-    
     if ds[0x0008, 0x0050].value.isdigit():
         dummy_id = il.get_fake_ID(ds[0x0008, 0x0050].value, _shift_pattern)
         logger.debug('%s -> %s' % (ds[0x0008, 0x0050].value, dummy_id))
@@ -101,45 +405,449 @@ def anonymize_fields(fname, fields_to_remove, fields_to_replace = None, dates_to
         dummy_id = il.get_fake_ID(dir_id, _shift_pattern)
         logger.debug('%s (%s) -> %s' % (ds[0x0008, 0x0050].value, dir_id, dummy_id))
 
-    odir = os.path.join(odir, dummy_id)
+    if lookup is not None:
+        lookup.setdefault((ds[0x0008, 0x0050].value, dir_id, dummy_id), fname)
+    else:
+        header = ['AccessionNumber', 'InputDir', 'DummyID']
+        write_to_csv(csvout, [ds[0x0008, 0x0050].value, dir_id, dummy_id], header, fname)
+
+    fout = fname if in_place else anonymized_path(fname, odir, dummy_id)
+
+    if actions is None:
+        actions = build_action_map(fields_to_remove, fields_to_replace, dates_to_replace)
+    remapper = None
+    if uid_key is not None:
+        remapper = ur.get_remapper(uid_key)
+        if 'MediaStorageSOPInstanceUID' in ds.file_meta:
+            ds.file_meta.MediaStorageSOPInstanceUID = remapper.remap(ds.file_meta.MediaStorageSOPInstanceUID)
+    apply_actions(ds, actions, remove_private = remove_private, remapper = remapper)
+
+    if study_id is not None and (0x0020, 0x0010) in ds:
+        ds[0x0020, 0x0010].value = study_id
+    # in the file itself, so it is never anonymized twice
+    ds.PatientIdentityRemoved = 'YES'
+    ds.DeidentificationMethod = _deidentification_method
+    return fout
+
+def save_anonymized(ds, fout, fname, pixel_offset, sync = False, redactions = None):
+    ''' Save a header anonymized by anonymize_dataset, creating its directory, see write_with_pixel_data. '''
     try:
-        os.makedirs(odir)
+        os.makedirs(os.path.dirname(fout))
     except:
         pass
-    
-    header = ['AccessionNumber', 'InputDir', 'DummyID']
-    write_to_csv(csvout, [ds[0x0008, 0x0050].value, dir_id, dummy_id], header, fname)
+    write_with_pixel_data(ds, fout, fname, pixel_offset, sync = sync, redactions = redactions)
 
-    fout = os.path.join(odir, tail)
+def anonymize_fields(fname, fields_to_remove, fields_to_replace = None, dates_to_replace = None, study_id = None, odir = None, force = False, lookup = None, actions = None, remove_private = False, uid_key = None, in_place = False, redaction_rules = None, unmatched = None):
+    ''' Anonymize a dicom and save it as odir/<dummy ID>/<file name>.
 
-    for tag in fields_to_replace:    
-        if tag in ds:
-            logger.debug('Tag to replace: %s %s' % (ds[tag].tag, ds[tag].name))
-            if ds[tag].value.isdigit():
-                dummy_id = il.get_fake_ID(ds[tag].value, _shift_pattern)
-                ds[tag].value = dummy_id #'Anonymized'
-            else:
-                logger.warning('Tag value of %s %s is not numeric thus shifting is not supported. Removing tag value instead.' % (ds[tag].tag, ds[tag].name))
-                ds[tag].value = ''
-              
-    for tag in fields_to_remove:
-        if tag in ds:
-            logger.debug('Tag to remove: %s %s' % (ds[tag].tag, ds[tag].name))
-            ds[tag].value = '' #'Anonymized'
-            
-            
-    for tag in dates_to_replace:
-        if tag in ds:
-            dummy_date = il.get_fake_ID(ds[tag].value, _date_shift_pattern)
-            ds[tag].value = dummy_date #'Anonymized'
-            
-    if study_id is not None and (0x0020, 0x0010) in ds:
-        ds[0x0020, 0x0010].value = study_id
-    
-    ds.save_as(fout)
+        The (AccessionNumber, InputDir, DummyID) mapping of the file is added
+        to lookup (see flush_lookup) if given, else appended to
+        odir/idLookup.csv right away under a file lock.
+
+        Only the header is parsed and rewritten; the pixel data is copied from
+        fname unchanged, see read_for_rewrite.
+
+        The fields are anonymized by apply_actions, with actions if given
+        (see build_action_map) instead of the three lists of fields.
+
+        With in_place, fname is replaced by the anonymized file instead, and
+        synced to disk before; its directory is not, see sync_dirs.
+
+        With in_place, a dicom anonymized already (see is_anonymized) is skipped.
+
+        With redaction_rules (see pixel_redaction.load_redaction_rules), the
+        rectangles of the rule matching the dicom are blacked out in the
+        pixel data of the output. If no rule matches, fname is appended to
+        unmatched if given.
+    '''
+
+    logger.debug('Anonymizing %s' % fname)
+
+    ds, pixel_offset = read_for_rewrite(fname, force = force)
+    if in_place and is_anonymized(ds):
+        logger.warning('%s is anonymized already, skipping it' % fname)
+        return 0
+    redactions = pr.find_redactions(ds, redaction_rules)
+    if redaction_rules is not None and not redactions:
+        logger.info('No redaction rule matches %s' % fname)
+        if unmatched is not None:
+            unmatched.append(fname)
+    fout = anonymize_dataset(ds, fname, odir, fields_to_remove, fields_to_replace, dates_to_replace,
+                             study_id = study_id, lookup = lookup, actions = actions, remove_private = remove_private,
+                             uid_key = uid_key, in_place = in_place)
+    save_anonymized(ds, fout, fname, pixel_offset, sync = in_place, redactions = redactions)
     logger.debug('Anonymized %s' % fout)
     return 0
+
+def _log_failure(f):
+    ''' Log the exception being handled as a failure to anonymize f. '''
+    logger.error('Failed to anonymize %s' % f)
+    tb.print_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
     
+def _anonymize_file(job):
+    ''' Run anonymize_fields on one file, logging instead of raising on failure.
+
+        :param job: A tuple of (file, fields to remove, keyword arguments for anonymize_fields).
+        :returns: A tuple of (file, status code of anonymize_fields or 1 if it failed,
+            id lookup entries of the file, UIDs remapped in this process since the last file,
+            whether no redaction rule matched the file).
+    '''
+    f, fields, kwargs = job
+    lookup = OrderedDict()
+    unmatched = []
+    try:
+        status=anonymize_fields(f, fields, lookup = lookup, unmatched = unmatched, **kwargs)
+    except:
+        _log_failure(f)
+        status=1
+    return f, status, lookup.items(), _drain_uids(kwargs), status == 0 and bool(unmatched)
+
+def _drain_uids(kwargs):
+    ''' Return the (original, new) UIDs remapped since the last call, see uid_remapping.UIDRemapper. '''
+    if kwargs.get('uid_key', None) is None:
+        return []
+    return ur.get_remapper(kwargs['uid_key']).drain()
+
+def iter_anonymize(dcms, fields, kwargs, jobs = 1, chunksize = 16):
+    ''' Anonymize files, in a pool of processes if jobs > 1.
+
+        Each file is anonymized by anonymize_fields exactly as in a serial
+        run. A failure is logged and reported as status 1 for that file only.
+        The id lookup entries are returned to the caller instead of being
+        written by the workers, see flush_lookup.
+
+        :param dcms: Files to anonymize.
+        :type dcms: list
+        :param fields: Fields to remove.
+        :type fields: list
+        :param kwargs: Keyword arguments for anonymize_fields.
+        :type kwargs: dict
+        :param jobs: Number of processes.
+        :type jobs: int
+        :param chunksize: Number of files sent to a process at a time.
+        :type chunksize: int
+        :returns: A generator of (file, status code, [((AccessionNumber, InputDir, DummyID), file), ...],
+            [(original UID, new UID), ...], whether no redaction rule matched the file), in the order of dcms.
+    '''
+    work = [(f, fields, kwargs) for f in dcms]
+    if jobs <= 1:
+        for job in work:
+            yield _anonymize_file(job)
+        return
+
+    from multiprocessing import Pool
+
+    pool = Pool(processes = jobs)
+    try:
+        for i, result in enumerate(pool.imap(_anonymize_file, work, chunksize)):
+            logger.info('%d/%d anonymized' % (i+1, len(dcms)))
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _pipeline_stage(name, func, inq, outq, num_threads, num_next, stats):
+    ''' Start num_threads daemon threads applying func to the items of inq and putting the results to outq.
+
+        An item is a tuple of (file, status, ...). Items that failed before
+        (status != 0) are passed on untouched; if func raises, the failure is
+        logged and (file, 1) is passed on. A None from inq ends a thread, and
+        num_next None are put to outq once all threads have ended.
+    '''
+    import threading, time
+
+    stats[name] = stage = dict(files = 0, bytes = 0, busy = 0.0, threads = num_threads)
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            item = inq.get()
+            if item is None:
+                break
+            if item[1] == 0:
+                start = time.time()
+                try:
+                    item, nbytes = func(item)
+                except:
+                    _log_failure(item[0])
+                    item, nbytes = (item[0], 1), 0
+                with lock:
+                    stage['files'] += 1
+                    stage['bytes'] += nbytes
+                    stage['busy'] += time.time() - start
+            outq.put(item)
+
+    threads = [threading.Thread(target = run) for i in range(num_threads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    def close():
+        for t in threads:
+            t.join()
+        for i in range(num_next):
+            outq.put(None)
+    closer = threading.Thread(target = close)
+    closer.daemon = True
+    closer.start()
+
+def anonymize_pipeline(dcms, kwargs, readers = 2, workers = 1, writers = 2, queue_size = 16, stats = None):
+    ''' Anonymize files with reading, anonymizing and writing overlapped.
+
+        Reader threads parse the headers (read_for_rewrite), worker threads
+        anonymize them (anonymize_dataset) and writer threads save them
+        (save_anonymized), with bounded queues of queue_size headers between
+        the stages. Pixel data is never held in the queues, it is copied by
+        the writers. As the stages run in threads, the workers share one CPU;
+        use iter_anonymize with jobs > 1 when anonymizing is the bottleneck.
+
+        :param dcms: Files to anonymize.
+        :type dcms: list
+        :param kwargs: Keyword arguments for anonymize_fields.
+        :type kwargs: dict
+        :param readers: Number of reader threads.
+        :type readers: int
+        :param workers: Number of worker threads.
+        :type workers: int
+        :param writers: Number of writer threads.
+        :type writers: int
+        :param queue_size: Maximum number of headers waiting between two stages.
+        :type queue_size: int
+        :param stats: If given, filled with the files, bytes, busy seconds and threads of each stage.
+        :type stats: dict
+        :returns: A generator of (file, status code, [((AccessionNumber, InputDir, DummyID), file), ...],
+            [(original UID, new UID), ...], whether no redaction rule matched the file), in the order files are done.
+    '''
+    import Queue
+
+    kwargs = dict(kwargs)
+    force = kwargs.pop('force', False)
+    odir = kwargs.pop('odir')
+    redaction_rules = kwargs.pop('redaction_rules', None)
+
+    def read(item):
+        f = item[0]
+        ds, pixel_offset = read_for_rewrite(f, force = force)
+        redactions = pr.find_redactions(ds, redaction_rules)
+        if redaction_rules is not None and not redactions:
+            logger.info('No redaction rule matches %s' % f)
+        if pixel_offset is not None:
+            # the pixel data is in the page cache by the time a writer copies it
+            prefetch(f, pixel_offset)
+        return (f, 0, ds, pixel_offset, redactions), pixel_offset or 0
+
+    def anonymize(item):
+        f, status, ds, pixel_offset, redactions = item
+        if kwargs.get('in_place', False) and is_anonymized(ds):
+            logger.warning('%s is anonymized already, skipping it' % f)
+            return (f, 0, ds, pixel_offset, redactions, None, []), 0
+        lookup = OrderedDict()
+        fout = anonymize_dataset(ds, f, odir, lookup = lookup, **kwargs)
+        return (f, 0, ds, pixel_offset, redactions, fout, lookup.items()), 0
+
+    def write(item):
+        f, status, ds, pixel_offset, redactions, fout, entries = item
+        if fout is None:
+            # skipped
+            return (f, 0, entries, False), 0
+        save_anonymized(ds, fout, f, pixel_offset, sync = kwargs.get('in_place', False), redactions = redactions)
+        logger.debug('Anonymized %s' % fout)
+        return (f, 0, entries, redaction_rules is not None and not redactions), os.path.getsize(fout)
+
+    if stats is None:
+        stats = {}
+    files = Queue.Queue()
+    for f in dcms:
+        files.put((f, 0))
+    for i in range(readers):
+        files.put(None)
+    headers = Queue.Queue(queue_size)
+    anonymized = Queue.Queue(queue_size)
+    done = Queue.Queue()
+    _pipeline_stage('read', read, files, headers, readers, workers, stats)
+    _pipeline_stage('anonymize', anonymize, headers, anonymized, workers, writers, stats)
+    _pipeline_stage('write', write, anonymized, done, writers, 1, stats)
+
+    i = 0
+    while True:
+        item = done.get()
+        if item is None:
+            break
+        i += 1
+        logger.info('%d/%d anonymized' % (i, len(dcms)))
+        if item[1] == 0:
+            yield item[0], 0, item[2], _drain_uids(kwargs), item[3]
+        else:
+            yield item[0], item[1], [], _drain_uids(kwargs), False
+
+def report_pipeline(stats, elapsed):
+    ''' Print the throughput of each stage of anonymize_pipeline.
+
+        :param stats: The stats filled by anonymize_pipeline.
+        :type stats: dict
+        :param elapsed: Wall time of the run, in seconds.
+        :type elapsed: float
+    '''
+    for name in ['read', 'anonymize', 'write']:
+        stage = stats[name]
+        # the rate the stage would sustain if it never waited on the others
+        capacity = stage['files'] * stage['threads'] / stage['busy'] if stage['busy'] > 0 else 0.0
+        print '%s: %d files, %.1f MB, busy %.0f%% of %d thread(s), %.1f files/s at most' % \
+              (name, stage['files'], stage['bytes'] / 1e6,
+               100.0 * stage['busy'] / (stage['threads'] * elapsed) if elapsed > 0 else 0.0,
+               stage['threads'], capacity)
+
+_manifest_name = '.anonymization_manifest.sqlite'
+
+def settings_hash(actions, remove_private = False, study_id = None, uid_key = None, redaction_rules = None):
+    ''' Hash everything, besides the input file, that an anonymized file depends on.
+
+        :param actions: A map of tag to action, see build_action_map.
+        :type actions: dict
+        :returns: A hex digest of the actions, the shift patterns, remove_private, study_id, uid_key
+            and redaction_rules.
+    '''
+    import hashlib
+    h = hashlib.sha1()
+    h.update(repr(sorted((int(tag), action) for tag, action in actions.iteritems())))
+    h.update(repr((_shift_pattern, _date_shift_pattern, remove_private, study_id, uid_key)))
+    h.update(repr(sorted((redaction_rules or {}).items())))
+    return h.hexdigest()
+
+def open_manifest(odir):
+    ''' Open (or create) the anonymization manifest in an output directory.
+
+        The manifest records the size and modification time of every input
+        file anonymized into odir, the settings_hash it was anonymized with,
+        and the size and modification time of its output, so that a later run
+        only anonymizes the files that are new, changed, or whose output is
+        missing, partial or stale.
+
+        :param odir: Output directory.
+        :type odir: str
+        :returns: A sqlite3.Connection.
+    '''
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(odir, _manifest_name), timeout = 60)
+    conn.execute('CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, directory TEXT, size INTEGER, '
+                 'mtime REAL, settings TEXT, output TEXT, output_size INTEGER, output_mtime REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+    conn.commit()
+    return conn
+
+def _stat(f):
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+def manifest_pending(conn, dcms, settings):
+    ''' Return the files that are not anonymized up to date according to the manifest.
+
+        :param conn: The manifest, see open_manifest.
+        :type conn: sqlite3.Connection
+        :param dcms: Input files.
+        :type dcms: list
+        :param settings: The settings_hash of this run.
+        :type settings: str
+        :returns: A list of the files of dcms to anonymize.
+    '''
+    entries = {}
+    for directory in set(os.path.dirname(os.path.abspath(f)) for f in dcms):
+        rows = conn.execute('SELECT source, size, mtime, settings, output, output_size, output_mtime '
+                            'FROM files WHERE directory = ?', (directory,))
+        entries.update((row[0], row[1:]) for row in rows)
+
+    pending = []
+    for f in dcms:
+        entry = entries.get(os.path.abspath(f))
+        if entry is not None and entry[2] == settings and _stat(f) == tuple(entry[:2]) and \
+           _stat(entry[3]) == tuple(entry[4:]):
+            continue
+        pending.append(f)
+    return pending
+
+def manifest_record(conn, done, settings):
+    ''' Record (input file, output file) pairs as anonymized up to date.
+
+        Call it only once the id lookup entries of the files are in
+        idLookup.csv, so that a skipped file never misses its entry.
+    '''
+    rows = []
+    for f, fout in done:
+        source = _stat(f)
+        output = _stat(fout)
+        if source is None or output is None:
+            continue
+        f = os.path.abspath(f)
+        rows.append((f, os.path.dirname(f)) + source + (settings, os.path.abspath(fout)) + output)
+    conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+
+_lookup_header = ['Image', 'AccessionNumber', 'InputDir', 'DummyID']
+
+def read_lookup_keys(fname):
+    ''' Return the (AccessionNumber, InputDir, DummyID) mappings already in an idLookup.csv.
+
+        :param fname: Path to idLookup.csv.
+        :type fname: str
+        :returns: A set of (AccessionNumber, InputDir, DummyID) tuples.
+    '''
+    keys = set()
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            for row in csv.reader(f, delimiter = ','):
+                # header rows, also repeated in the _tmp files of write_to_csv
+                if len(row) < 4 or row == _lookup_header:
+                    continue
+                keys.add(tuple(row[1:4]))
+    return keys
+
+def flush_lookup(fname, lookup, written):
+    ''' Append the new (AccessionNumber, InputDir, DummyID) mappings to idLookup.csv.
+
+        Only the first image of a mapping is written, and mappings already in
+        written are skipped, so the file gets one row per study. The rows are
+        appended under a file lock, as other runs may write to the same
+        odir; on a lock timeout they go to a file of their own, as in
+        write_to_csv.
+
+        :param fname: Path to idLookup.csv.
+        :type fname: str
+        :param lookup: Mappings to image collected since the last flush. Cleared.
+        :type lookup: OrderedDict
+        :param written: Mappings already in fname, e.g. from read_lookup_keys. Updated.
+        :type written: set
+        :returns: Number of rows written.
+    '''
+    rows = [[image] + list(key) for key, image in lookup.iteritems() if key not in written]
+    if rows:
+        lock = lockfile.FileLock(fname)
+        lock.timeout = 200
+        try:
+            with lock:
+                isfile = os.path.isfile(fname)
+                with open(fname, 'ab') as f:
+                    writer = csv.writer(f, delimiter = ',')
+                    if not isfile:
+                        writer.writerow(_lookup_header)
+                    writer.writerows(rows)
+        except lockfile.LockTimeout:
+            # lock.unique_name: hostname-tname.pid-somedigits
+            fname_tmp = fname + '_' + os.path.split(lock.unique_name)[1]
+            logger.warning('Lock timeout. Log the entries to ' + fname_tmp)
+            with open(fname_tmp, 'ab') as f:
+                writer = csv.writer(f, delimiter = ',')
+                writer.writerow(_lookup_header)
+                writer.writerows(rows)
+    written.update(lookup.iterkeys())
+    lookup.clear()
+    return len(rows)
+
 def write_to_csv(fname, array, header, subject):
     head, tail = os.path.split(fname)
     if not os.path.isdir(head):
@@ -192,7 +900,7 @@ def create_parser():
                         dest = 'odir',
                         action = 'store',
                         type = str,
-                        help = 'Output directory to find files. If not specified, it will overwrite the input files directly.')
+                        help = 'Output directory, for the anonymized files unless --in_place and for idLookup.csv. If not specified, the input directory is used.')
     parser.add_argument('-f', '--fields',
                         dest = 'fields',
                         action = 'store',
@@ -210,10 +918,81 @@ def create_parser():
                         action = 'store_true',
                         default = False,
                         help = 'Find dicoms recursively. Default: False')
+    parser.add_argument('--force',
+                        dest = 'force',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Also anonymize files without the 128-byte preamble and DICM marker. Default: False')
+    parser.add_argument('--remove_private',
+                        dest = 'remove_private',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Also remove the private elements, including those in sequences. Default: False')
     parser.add_argument('-v', '--verbose',
                         dest = 'verbosity',
                         action = 'count',
                         help = 'Increase verbosity of the program. By calling the flag multiple time, the verbosity can be further increased. Max: 2 levels (-v -v)')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of processes to anonymize files in parallel. Default: 1')
+    parser.add_argument('--checkpoint',
+                        dest = 'checkpoint',
+                        action = 'store',
+                        default = 1000,
+                        type = int,
+                        help = 'Write the new id mappings to idLookup.csv (and the manifest) every this many files (and at the end). Default: 1000')
+    parser.add_argument('--manifest',
+                        dest = 'manifest',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Keep a manifest (%s) in the output directory, and skip the files anonymized before with the same tag table, shift patterns and options whose input and output are unchanged since. Default: False' % _manifest_name)
+    parser.add_argument('--redact',
+                        dest = 'redact',
+                        action = 'store',
+                        nargs = '?',
+                        const = _redaction_rules_file,
+                        type = str,
+                        help = 'Black out burned-in annotations in the pixel data, with the rules of a csv like pixel_redaction_rules.csv (the default without a value), which must not be empty. Files with compressed pixel data that match a rule fail instead of being written unredacted.')
+    parser.add_argument('--in_place',
+                        dest = 'in_place',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Replace each input file by its anonymized version, atomically and synced to disk, instead of writing it to <output>/<dummy ID>/. Files already anonymized, which are marked by their DeidentificationMethod, are skipped, so a rerun after a crash does not anonymize them twice; --manifest also skips them without reading them. Default: False')
+    parser.add_argument('--remap_uids',
+                        dest = 'remap_uids',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Remap every UID, including those in sequences, to a 2.25 UID from a keyed hash of it (see uid_remapping.py), instead of its action in the tag table. UIDs of the DICOM standard (1.2.840.10008.*) are kept. Default: False')
+    parser.add_argument('--uid_key',
+                        dest = 'uid_key',
+                        action = 'store',
+                        type = str,
+                        help = 'Secret key to remap UIDs with. The same key gives the same UIDs across runs. Default: the shift pattern.')
+    parser.add_argument('--uid_store',
+                        dest = 'uid_store',
+                        action = 'store',
+                        type = str,
+                        help = 'A SQLite file to record the remapped UIDs in, that several runs can share.')
+    parser.add_argument('--pipeline',
+                        dest = 'pipeline',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Overlap reading, anonymizing and writing files in threads, and report the throughput of each stage. Cannot be used with --jobs. Default: False')
+    parser.add_argument('--io_threads',
+                        dest = 'io_threads',
+                        action = 'store',
+                        default = 2,
+                        type = int,
+                        help = 'Number of reader and of writer threads with --pipeline. Default: 2')
+    parser.add_argument('--queue_size',
+                        dest = 'queue_size',
+                        action = 'store',
+                        default = 16,
+                        type = int,
+                        help = 'Maximum number of headers waiting between two stages with --pipeline. Default: 16')
                         
     return parser
     
@@ -224,6 +1003,10 @@ def main(argv = None):
     # parse input from command line
     parser = create_parser()
     args = parser.parse_args(argv)
+    if args.pipeline and args.jobs > 1:
+        parser.error('--pipeline cannot be used with --jobs.')
+    if args.checkpoint < 1:
+        parser.error('--checkpoint must be at least 1.')
     
     import socket, time
 
@@ -247,7 +1030,7 @@ def main(argv = None):
     logger.setLevel(log_level)
     
     #logger.info('Fields anonymizing: %s' % args.fields)
-    dcms = discover_files(args.idir, recursive = args.recursive)
+    dcms = discover_files(args.idir, recursive = args.recursive, force = args.force)
     logger.info('Anonymizing %d dicoms in %s' % (len(dcms), args.idir)) 
     
     # TODO 20180607 odir setup needs more consideration for various of situation.
@@ -267,15 +1050,71 @@ def main(argv = None):
     except:
         pass
     
-    status_codes = []    
-    for f in dcms:
-        try:
-            status=anonymize_fields(f, args.fields, fields_to_replace = _fields_to_replace, dates_to_replace = _fields_to_replace_date, study_id = args.study_id, odir = odir)
-        except:
-            logger.error('Failed to anonymize %s' % f)
-            tb.print_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
-            status=1
-        status_codes.append(status)
+    # compiled once, not for every file
+    actions = build_action_map(args.fields, _fields_to_replace, _fields_to_replace_date)
+    uid_key = None
+    if args.remap_uids:
+        uid_key = args.uid_key if args.uid_key is not None else _shift_pattern
+    redaction_rules = None
+    if args.redact is not None:
+        redaction_rules = pr.load_redaction_rules(args.redact)
+        if not redaction_rules:
+            parser.error('--redact: no redaction rule in %s.' % args.redact)
+    kwargs = dict(actions = actions, remove_private = args.remove_private, uid_key = uid_key, redaction_rules = redaction_rules,
+                  study_id = args.study_id, odir = odir, force = args.force, in_place = args.in_place)
+    csvout = os.path.join(odir, 'idLookup.csv')
+    written = read_lookup_keys(csvout)
+    lookup = OrderedDict()
+    status_codes = []
+    num_unmatched = 0
+    if args.manifest:
+        manifest = open_manifest(odir)
+        settings = settings_hash(actions, args.remove_private, args.study_id, uid_key, redaction_rules)
+        pending = manifest_pending(manifest, dcms, settings)
+        logger.info('%d dicoms up to date, anonymizing %d' % (len(dcms) - len(pending), len(pending)))
+        dcms = pending
+    done = []
+    uids = []
+    if args.uid_store is not None:
+        uid_store = ur.open_uid_store(args.uid_store)
+
+    def checkpoint():
+        if args.uid_store is not None:
+            ur.store_uids(uid_store, uids)
+        del uids[:]
+        if args.in_place:
+            # one sync per directory for the files renamed into it
+            sync_dirs(os.path.dirname(fout) for f, fout in done)
+        # the manifest only after idLookup.csv, see manifest_record
+        flush_lookup(csvout, lookup, written)
+        if args.manifest:
+            manifest_record(manifest, done, settings)
+        del done[:]
+
+    if args.pipeline:
+        stats = {}
+        results = anonymize_pipeline(dcms, kwargs, readers = args.io_threads, writers = args.io_threads,
+                                     queue_size = args.queue_size, stats = stats)
+    else:
+        results = iter_anonymize(dcms, args.fields, kwargs, jobs = args.jobs)
+    start = time.time()
+    try:
+        for f, status, entries, new_uids, unmatched in results:
+            status_codes.append(status)
+            num_unmatched += unmatched
+            for key, image in entries:
+                lookup.setdefault(key, image)
+            uids.extend(new_uids)
+            if status == 0 and entries:
+                done.append((f, f if args.in_place else anonymized_path(f, odir, entries[0][0][2])))
+            if len(status_codes) % args.checkpoint == 0:
+                checkpoint()
+    finally:
+        checkpoint()
+    if args.pipeline:
+        report_pipeline(stats, time.time() - start)
+    if num_unmatched > 0:
+        logger.warning('%d of %d dicoms matched no redaction rule, their pixel data is not redacted' % (num_unmatched, len(dcms)))
     
     return int(any(status_codes))
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'uid_remapping.py'
+
+import sys, os
+import hmac
+import hashlib
+import binascii
+import sqlite3
+from collections import OrderedDict
+
+## UIDs under the DICOM root name SOP classes, transfer syntaxes and other
+## standard objects, not patients or studies, and are never remapped.
+_dicom_root = '1.2.840.10008.'
+
+def remap_uid(uid, key):
+    ''' Return the 2.25 UID a UID is remapped to with a key.
+
+        The new UID is the first 128 bits of HMAC-SHA256(key, uid) as a
+        decimal integer under the 2.25 root, so the same UID always maps to
+        the same new UID with the same key, and it cannot be recovered
+        without the key.
+
+        :param uid: An original UID.
+        :type uid: str
+        :param key: A secret key.
+        :type key: str
+        :returns: A UID of at most 44 characters.
+    '''
+    digest = hmac.new(key, uid, hashlib.sha256).digest()[:16]
+    return '2.25.%d' % int(binascii.hexlify(digest), 16)
+
+class UIDRemapper(object):
+    ''' Remap UIDs with remap_uid, caching the most recently used ones.
+
+        The mapping only depends on the key, so remappers of different
+        processes agree without sharing anything. The pairs remapped since the
+        last drain are kept to be written to a UID store (see store_uids).
+    '''
+    def __init__(self, key, cache_size = 100000):
+        self.key = key
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._new = []
+
+    def remap(self, uid):
+        ''' Remap a UID, or return it unchanged if it is empty or under the DICOM root. '''
+        uid = uid.rstrip('\x00').strip()
+        if not uid or uid.startswith(_dicom_root):
+            return uid
+        new_uid = self._cache.pop(uid, None)
+        if new_uid is None:
+            new_uid = remap_uid(uid, self.key)
+            self._new.append((uid, new_uid))
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last = False)
+        self._cache[uid] = new_uid
+        return new_uid
+
+    def drain(self):
+        ''' Return the (original, new) pairs remapped since the last drain. '''
+        new, self._new = self._new, []
+        return new
+
+## Remappers of this process, by key.
+_remappers = {}
+
+def get_remapper(key):
+    ''' Return the UIDRemapper of this process for a key, so that its cache
+        is kept across files, e.g. in pool workers.
+    '''
+    if key not in _remappers:
+        _remappers[key] = UIDRemapper(key)
+    return _remappers[key]
+
+def open_uid_store(store):
+    ''' Open (or create) a UID store, a record of the UIDs remapped so far.
+
+        Several runs, or machines on a shared filesystem, can add to the same
+        store; remapping never reads it.
+
+        :param store: Path to the store.
+        :type store: str
+        :returns: A sqlite3.Connection.
+    '''
+    conn = sqlite3.connect(store, timeout = 60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS uids (original TEXT PRIMARY KEY, remapped TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS uids_remapped ON uids (remapped)')
+    conn.commit()
+    return conn
+
+def store_uids(conn, pairs):
+    ''' Add (original, new) UID pairs to a UID store, in one transaction. '''
+    conn.executemany('INSERT OR IGNORE INTO uids VALUES (?, ?)', pairs)
+    conn.commit()
+
+def lookup_uids(conn, uids, reverse = False):
+    ''' Look up UIDs in a UID store.
+
+        :param uids: Original UIDs, or remapped ones if reverse.
+        :type uids: list
+        :returns: A dict of the UIDs found to their remapped (or original) UID.
+    '''
+    if reverse:
+        query = 'SELECT remapped, original FROM uids WHERE remapped = ?'
+    else:
+        query = 'SELECT original, remapped FROM uids WHERE original = ?'
+    found = {}
+    for uid in uids:
+        row = conn.execute(query, (uid,)).fetchone()
+        if row is not None:
+            found[row[0]] = row[1]
+    return found
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Look up UIDs in a UID store written by remove_dicom_fields.py --uid_store.')
+    # Required
+    parser.add_argument('-x', '--store',
+                        required = True,
+                        dest = 'store',
+                        action = 'store',
+                        type = str,
+                        help = 'UID store file.')
+    parser.add_argument('uids',
+                        nargs = '+',
+                        help = 'UIDs to look up.')
+
+    # Optional
+    parser.add_argument('-r', '--reverse',
+                        dest = 'reverse',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Look up the original UIDs of remapped UIDs. Default: False')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    args = create_parser().parse_args(argv)
+
+    found = lookup_uids(open_uid_store(args.store), args.uids, reverse = args.reverse)
+    for uid in args.uids:
+        print '%s,%s' % (uid, found.get(uid, ''))
+    return int(len(found) < len(args.uids))
+
+if __name__ == '__main__':
+    sys.exit(main())
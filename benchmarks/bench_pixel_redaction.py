@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'bench_pixel_redaction.py'
+
+import os, sys
+import time
+import shutil
+import tempfile
+import logging as log
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'anonymization'))
+from dicom.dataset import Dataset, FileDataset
+import remove_dicom_fields as rdf
+
+_manufacturer, _model = 'BENCH', 'US-1'
+
+def make_dicom(fname, accession, rows, columns, samples, bits, frames):
+    ''' Write a synthetic uncompressed dicom with a numeric accession number. '''
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    file_meta.MediaStorageSOPInstanceUID = '1.2.3.4.5.6.7'
+    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    file_meta.ImplementationClassUID = '1.2.3.4'
+    ds = FileDataset(fname, {}, file_meta = file_meta, preamble = b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.AccessionNumber = accession
+    ds.PatientName = 'Bench^Patient'
+    ds.PatientID = '87654321'
+    ds.StudyID = '42'
+    ds.Manufacturer = _manufacturer
+    ds.ManufacturerModelName = _model
+    ds.SamplesPerPixel = samples
+    ds.PhotometricInterpretation = 'RGB' if samples == 3 else 'MONOCHROME2'
+    if samples == 3:
+        ds.PlanarConfiguration = 0
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.BitsAllocated = bits
+    ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    ds.PixelData = os.urandom(frames * rows * columns * samples * bits / 8)
+    ds.data_element('PixelData').VR = 'OB' if bits == 8 else 'OW'
+    ds.save_as(fname)
+
+def time_anonymize(dcms, odir, **kwargs):
+    ''' Return the seconds per file to anonymize dcms serially. '''
+    actions = rdf.build_action_map(rdf._fields_to_remove, rdf._fields_to_replace, rdf._fields_to_replace_date)
+    start = time.time()
+    for f in dcms:
+        rdf.anonymize_fields(f, None, odir = odir, actions = actions, lookup = {}, **kwargs)
+    return (time.time() - start) / len(dcms)
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Benchmark the pixel redaction of remove_dicom_fields against header-only anonymization.')
+    parser.add_argument('-n', '--num_files',
+                        dest = 'num_files',
+                        action = 'store',
+                        default = 20,
+                        type = int,
+                        help = 'Number of files per image size. Default: 20.')
+    parser.add_argument('-d', '--dir',
+                        dest = 'dir',
+                        action = 'store',
+                        type = str,
+                        help = 'Directory to write the synthetic files to. Default: a temporary directory, removed at the end.')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = create_parser().parse_args(argv)
+    rdf.logger.setLevel(log.ERROR)
+
+    # (rows, columns, samples, bits, frames): ultrasound, secondary capture, cine loop
+    sizes = [(480, 640, 3, 8, 1), (2048, 2048, 1, 16, 1), (600, 800, 3, 8, 50)]
+    work = args.dir if args.dir is not None else tempfile.mkdtemp()
+    try:
+        print "%22s %8s %14s %14s %12s" % ('image', 'MB', 'header (ms)', 'redact (ms)', 'overhead')
+        for i, (rows, columns, samples, bits, frames) in enumerate(sizes):
+            idir = os.path.join(work, 'in', '%dx%dx%dx%dx%d' % (rows, columns, samples, bits, frames))
+            os.makedirs(idir)
+            dcms = [os.path.join(idir, '%d.dcm' % n) for n in range(args.num_files)]
+            for f in dcms:
+                make_dicom(f, '1234567%d' % i, rows, columns, samples, bits, frames)
+            # a banner at the top and a box at the bottom left of every image
+            rules = {(_manufacturer, _model, rows, columns):
+                     [(0, 0, 40, columns), (rows - 60, 0, rows, 200)]}
+
+            header = time_anonymize(dcms, os.path.join(work, 'header'))
+            redact = time_anonymize(dcms, os.path.join(work, 'redact'), redaction_rules = rules)
+            print "%22s %8.1f %14.1f %14.1f %11.0f%%" % ('%dx%d %dx%d-bit x%d' % (rows, columns, samples, bits, frames),
+                                                      os.path.getsize(dcms[0]) / 1e6, header * 1e3, redact * 1e3,
+                                                      100.0 * (redact - header) / header)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(work)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
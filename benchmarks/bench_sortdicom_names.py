@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'bench_sortdicom_names.py'
+
+import os, sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sortdicom import resolve_name
+
+def make_names(num_files, collide):
+    ''' Return (new_name, seq_to_join) pairs as sortdicom builds them for a
+        single series directory.
+
+        :param num_files: Number of files in the directory.
+        :type num_files: int
+        :param collide: If True, no instance numbers are available and every
+            file starts at the same name (worst case). Otherwise the instance
+            numbers are unique.
+        :type collide: boolean
+    '''
+    seq_to_join = ['12345678', 'MR', 'AXIAL_T1-3']
+    out = []
+    for i in xrange(num_files):
+        index2 = '1' if collide else str(i + 1)
+        out.append(('_'.join(seq_to_join + [index2]), seq_to_join))
+    return out
+
+def legacy_resolve(pairs, delimiter = '_'):
+    names = []
+    for new_name, seq_to_join in pairs:
+        index = 1
+        while (new_name in names):
+            index += 1
+            new_name = delimiter.join(seq_to_join + [str(index)])
+        names.append(new_name)
+    return names
+
+def indexed_resolve(pairs, delimiter = '_'):
+    taken = set()
+    next_index = {}
+    return [resolve_name(new_name, seq_to_join, taken, next_index, delimiter)
+            for new_name, seq_to_join in pairs]
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Benchmark the name collision resolver in sortdicom.')
+    parser.add_argument('-n', '--num_files',
+                        dest = 'num_files',
+                        action = 'store',
+                        default = [10000, 50000, 200000],
+                        type = int,
+                        nargs = '+',
+                        help = 'Number of files per directory. Default: 10000 50000 200000.')
+    parser.add_argument('--legacy_max',
+                        dest = 'legacy_max',
+                        action = 'store',
+                        default = 10000,
+                        type = int,
+                        help = 'Also time the list-scanning resolver up to this many files. It is O(n^2) with unique names and O(n^3) with colliding names. Default: 10000.')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = create_parser().parse_args(argv)
+
+    print "%10s %10s %12s %12s" % ('files', 'names', 'indexed (s)', 'legacy (s)')
+    for num_files in args.num_files:
+        for collide in [False, True]:
+            pairs = make_names(num_files, collide)
+
+            start = time.time()
+            names = indexed_resolve(pairs)
+            indexed = time.time() - start
+
+            legacy = float('nan')
+            # colliding names are O(n^3) in the legacy resolver, so only time a tenth.
+            legacy_limit = args.legacy_max if not collide else args.legacy_max / 10
+            if num_files <= legacy_limit:
+                start = time.time()
+                assert legacy_resolve(pairs) == names
+                legacy = time.time() - start
+
+            print "%10d %10s %12.3f %12.3f" % (num_files, 'collide' if collide else 'unique', indexed, legacy)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
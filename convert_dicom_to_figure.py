@@ -5,10 +5,45 @@ __EXEC__ = __file__
 # Import modules here
 import os, sys
 import traceback as tb
-import matplotlib.pyplot as plt
+import struct
+import zlib
 import numpy as np
+
+## Formats the direct renderer (render_preview) can write. PNG is written
+## with zlib alone; the others need Pillow.
+_preview_formats = ['png', 'jpg', 'tif']
+
+## The figure of this process, reused by convert_dicom_to_figure for every image.
+_figure = None
+
+def use_agg():
+    ''' Select the non-interactive Agg backend, before pyplot is imported,
+        as figures are only written to files.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+def get_figure():
+    ''' Return the figure of this process, creating it on first use.
+
+        It is a plain Figure on an Agg canvas, not a pyplot figure, so neither
+        the figure nor its canvas are created again for each image, and pyplot
+        does not keep it alive.
+
+        :returns: A matplotlib.figure.Figure, to be cleared after use.
+    '''
+    global _figure
+    if _figure is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        _figure = Figure()
+        FigureCanvasAgg(_figure)
+    return _figure
     
-def create_collage(dcms, outname, mammogram = False, dpi=100):       
+def create_collage(dcms, outname, mammogram = False, dpi=100, seg_cache = None):       
+    import matplotlib.pyplot as plt
+
     num_col = np.ceil(len(dcms)/2.).astype(np.int)
     f, axes = plt.subplots(2, num_col, figsize = (num_col*5,10))
     
@@ -19,7 +54,7 @@ def create_collage(dcms, outname, mammogram = False, dpi=100):
                                        labelbottom='off', right='off', left='off', labelleft='off')
             axes[i%2][i/2].set_title(tail, fontsize = 20)
             if mammogram:
-                plot_mammogram(dcm, axes[i%2][i/2])
+                plot_mammogram(dcm, axes[i%2][i/2], seg_cache = seg_cache)
             else:
                 plot_dicom(dcm, axes[i%2][i/2])
         except:
@@ -34,6 +69,7 @@ def create_collage(dcms, outname, mammogram = False, dpi=100):
 
 def plot_dicom(dcm, ax = None):
     import dicom
+    import matplotlib.pyplot as plt
     
     if ax is None:
         f, ax = plt.subplots(1,1)
@@ -45,21 +81,17 @@ def plot_dicom(dcm, ax = None):
     
     return ax
     
-def plot_mammogram(dcm, ax = None):
-    import libra
-    from skimage.transform import resize
-    from skimage.measure import find_contours
+def plot_mammogram(dcm, ax = None, seg_cache = None):
+    from mammogram_segmentation import cached_segmentation
+    import matplotlib.pyplot as plt
 
     if ax is None:
         f, ax = plt.subplots(1,1)
 
-    m = libra.io.read_image(dcm)
-    m_out = libra.preprocessing.standardize_intensity(libra.preprocessing.standardize_orientation(m))
-    image = resize(m_out.image, np.array(m_out.image.shape)/4, preserve_range=True)
+    # the segmentation is read from its sidecar in seg_cache if there is one
+    image, mask, contour = cached_segmentation(dcm, seg_cache)
     ax.imshow(image, cmap='gray') # , vmin = low_window, vmax = high_window)
         
-    mask, breast = libra.segmentation.segment_breast(image, pecseg=m_out.IsMLO)
-    contour = find_contours(mask, 0.8) 
     for j in xrange(len(contour)):
         ax.plot(contour[j][:,1], contour[j][:,0], 'r', linewidth = 2)
     
@@ -68,20 +100,321 @@ def plot_mammogram(dcm, ax = None):
     
     return ax
     
-def convert_dicom_to_figure(dcm, outname, mammogram = False, dpi=100):
+def convert_dicom_to_figure(dcm, outname, mammogram = False, dpi=100, seg_cache = None):
     _, tail = os.path.split(dcm)
-    
-    if mammogram:
-        ax = plot_mammogram(dcm)
+
+    fig = get_figure()
+    try:
+        ax = fig.add_subplot(1, 1, 1)
+        if mammogram:
+            plot_mammogram(dcm, ax, seg_cache = seg_cache)
+        else:
+            plot_dicom(dcm, ax)
+
+        ax.tick_params(axis='both', which='both', bottom='off', top='off',
+                       labelbottom='off', right='off', left='off', labelleft='off')
+        ax.set_title(tail, fontsize = 20)
+
+        fig.savefig(outname, dpi=dpi, bbox_inches='tight')
+    finally:
+        # release the image before the next one
+        fig.clf()
+
+def _first_value(value):
+    ''' Return the first of a multi-valued element (e.g. several windows) as a float. '''
+    if isinstance(value, (list, tuple)):
+        value = value[0]
+    return float(value)
+
+def downsample(image, size):
+    ''' Shrink an image by block averaging so that its largest side is at most size.
+
+        :param image: An image of shape (rows, columns) or (rows, columns, samples).
+        :type image: numpy.ndarray
+        :param size: Largest side of the result in pixels.
+        :type size: int
+        :returns: A float32 image of at least one row and one column, or the
+            image unchanged if it is small enough.
+    '''
+    factor = int(np.ceil(max(image.shape[:2]) / float(size)))
+    if factor <= 1:
+        return image
+    # a side shorter than factor is averaged into a single pixel, not zero
+    row_factor = min(factor, image.shape[0])
+    column_factor = min(factor, image.shape[1])
+    rows = image.shape[0] // row_factor
+    columns = image.shape[1] // column_factor
+    blocks = image[:rows*row_factor, :columns*column_factor].reshape((rows, row_factor, columns, column_factor) + image.shape[2:])
+    return blocks.mean(axis = 3, dtype = np.float32).mean(axis = 1)
+
+def apply_windowing(image, ds):
+    ''' Map stored pixel values to 8 bits for display, as a viewer would.
+
+        The modality rescale (RescaleSlope, RescaleIntercept) is applied first,
+        then the VOI LUT if there is one, else the first window (WindowCenter,
+        WindowWidth), else the full range of the image. MONOCHROME1 is inverted.
+        Color images are only clipped to 8 bits.
+
+        :param image: Pixel values of one frame, possibly downsampled.
+        :type image: numpy.ndarray
+        :param ds: The dataset of the image.
+        :type ds: dicom.dataset.Dataset
+        :returns: A uint8 image.
+    '''
+    if int(getattr(ds, 'SamplesPerPixel', 1)) > 1:
+        if int(getattr(ds, 'BitsStored', 8)) > 8:
+            image = image / float(2**(int(ds.BitsStored) - 8))
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+    image = image.astype(np.float32)
+    slope = float(getattr(ds, 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(ds, 'RescaleIntercept', 0) or 0)
+    if slope != 1 or intercept != 0:
+        image = image*slope + intercept
+
+    if 'VOILUTSequence' in ds and len(ds.VOILUTSequence) > 0:
+        item = ds.VOILUTSequence[0]
+        entries, first, bits = [int(v) for v in item.LUTDescriptor]
+        lut = item.LUTData
+        if isinstance(lut, str):
+            lut = np.fromstring(lut, dtype = '<u2' if ds.is_little_endian else '>u2')
+        lut = np.asarray(lut, dtype = np.float32)[:entries or 65536]
+        index = np.clip(np.round(image) - first, 0, len(lut) - 1).astype(np.intp)
+        image = lut[index] / (2.**bits - 1)
+    elif 'WindowCenter' in ds and 'WindowWidth' in ds:
+        center = _first_value(ds.WindowCenter)
+        width = max(_first_value(ds.WindowWidth), 2.)
+        image = (image - (center - 0.5)) / (width - 1) + 0.5
     else:
-        ax = plot_dicom(dcm)
-    
-    ax.tick_params(axis='both', which='both', bottom='off', top='off',
-                   labelbottom='off', right='off', left='off', labelleft='off')
-    ax.set_title(tail, fontsize = 20)
-        
-    plt.savefig(outname, dpi=dpi, bbox_inches='tight')
-    plt.close('all')
+        low, high = image.min(), image.max()
+        image = (image - low) / max(high - low, 1e-6)
+
+    image = np.clip(image, 0, 1)
+    if str(getattr(ds, 'PhotometricInterpretation', '')) == 'MONOCHROME1':
+        image = 1 - image
+    return (image*255 + 0.5).astype(np.uint8)
+
+def write_png(outname, image):
+    ''' Write an 8-bit grayscale or RGB image as a PNG with zlib only.
+
+        :param outname: Output file.
+        :type outname: str
+        :param image: A uint8 image of shape (rows, columns) or (rows, columns, 3).
+        :type image: numpy.ndarray
+    '''
+    rows, columns = image.shape[:2]
+    color_type = 0 if image.ndim == 2 else 2
+    # every row starts with its filter type, 0 (none)
+    raw = np.zeros((rows, 1 + image[0].size), dtype = np.uint8)
+    raw[:, 1:] = image.reshape(rows, -1)
+
+    def chunk(kind, data):
+        return struct.pack('>L', len(data)) + kind + data + struct.pack('>L', zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(outname, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>LLBBBBB', columns, rows, 8, color_type, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(raw.tostring(), 6)))
+        f.write(chunk('IEND', ''))
+
+def write_preview(outname, image, text = None, quality = 90, labels = None):
+    ''' Write an 8-bit image, with an optional text overlay in its top left corner.
+
+        Pillow is used if it is installed. Without it only PNG can be
+        written, and the text is left out.
+
+        :param outname: Output file, its format given by its extension.
+        :type outname: str
+        :param image: A uint8 image of shape (rows, columns) or (rows, columns, 3).
+        :type image: numpy.ndarray
+        :param text: Text to draw, e.g. the file name. None for no text.
+        :type text: str
+        :param quality: JPEG quality.
+        :type quality: int
+        :param labels: More text to draw, as a list of (top, left, text), e.g.
+            one per tile of a mosaic.
+        :type labels: list
+    '''
+    labels = list(labels or [])
+    if text:
+        labels.insert(0, (0, 0, text))
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        if not outname.lower().endswith('.png'):
+            raise ImportError('Pillow is needed to write %s' % outname)
+        if labels:
+            print "Pillow is not installed, writing %s without text" % outname
+        write_png(outname, image)
+        return
+
+    img = Image.fromarray(image)
+    if labels:
+        draw = ImageDraw.Draw(img)
+        white = 255 if img.mode == 'L' else (255, 255, 255)
+        for top, left, label in labels:
+            width, height = draw.textsize(label)
+            draw.rectangle([left, top, left + width + 8, top + height + 8], fill = 0)
+            draw.text((left + 4, top + 4), label, fill = white)
+    img.save(outname, quality = quality)
+
+def render_dicom(dcm, size = 1024):
+    ''' Render the first frame of a dicom to an 8-bit image, without matplotlib.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param size: Largest side of the image in pixels, see downsample.
+        :type size: int
+        :returns: A uint8 image of shape (rows, columns) or (rows, columns, 3).
+    '''
+    import dicom
+
+    ds = dicom.read_file(dcm)
+    image = ds.pixel_array
+    samples = int(getattr(ds, 'SamplesPerPixel', 1))
+    if image.ndim > (2 if samples == 1 else 3):
+        image = image[0]
+    if samples > 1 and image.shape[0] == samples and int(getattr(ds, 'PlanarConfiguration', 0)) == 1:
+        image = np.rollaxis(image, 0, 3)
+    return apply_windowing(downsample(image, size), ds)
+
+def render_preview(dcm, outname, size = 1024, text = True):
+    ''' Write a preview of a dicom directly: windowed with NumPy, downsampled
+        and encoded as an 8-bit image, without building a figure.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param outname: Output file, png, jpg or tif.
+        :type outname: str
+        :param size: Largest side of the preview in pixels.
+        :type size: int
+        :param text: Draw the file name over the image, in place of the title of
+            convert_dicom_to_figure.
+        :type text: boolean
+    '''
+    _, tail = os.path.split(dcm)
+    write_preview(outname, render_dicom(dcm, size), text = tail if text else None)
+
+def mosaic_grid(num_img, grid = None):
+    ''' Return the (rows, columns) of a mosaic of num_img tiles: grid if
+        given, else the most square grid, one column more than rows if uneven.
+    '''
+    if grid is not None:
+        rows, columns = grid
+        if rows*columns < num_img:
+            raise ValueError('A grid of %dx%d is too small for %d images.' % (rows, columns, num_img))
+        return rows, columns
+    columns = int(np.ceil(np.sqrt(num_img)))
+    return int(np.ceil(num_img / float(columns))), columns
+
+def create_mosaic(dcms, outname, grid = None, tile = 512, text = True):
+    ''' Create a collage as one 8-bit image, a mosaic of tiles filled row by row.
+
+        The dicoms are read one at a time and each is reduced to its tile (see
+        render_dicom) before the next is read, so memory holds the mosaic and
+        one full resolution image at most, however many images there are. The
+        mosaic is grayscale until a color image comes. Tiles of images that
+        fail are left black.
+
+        :param dcms: Paths to dicom files.
+        :type dcms: list
+        :param outname: Output file, png, jpg or tif.
+        :type outname: str
+        :param grid: (rows, columns) of tiles. None for the most square grid.
+        :type grid: tuple
+        :param tile: Side of the square tiles in pixels.
+        :type tile: int
+        :param text: Draw the file names over their tiles.
+        :type text: boolean
+        :returns: A list of (dcm, error) of the images that failed.
+    '''
+    rows, columns = mosaic_grid(len(dcms), grid)
+    mosaic = np.zeros((rows*tile, columns*tile), dtype = np.uint8)
+    labels = []
+    failures = []
+    for i, dcm in enumerate(dcms):
+        try:
+            image = render_dicom(dcm, tile)
+        except Exception:
+            failures.append((dcm, tb.format_exc().strip().splitlines()[-1]))
+            continue
+        if image.ndim == 3 and mosaic.ndim == 2:
+            mosaic = np.repeat(mosaic[:, :, np.newaxis], 3, axis = 2)
+        elif image.ndim == 2 and mosaic.ndim == 3:
+            image = image[:, :, np.newaxis]
+        # centered in its tile
+        top = (i // columns)*tile + (tile - image.shape[0]) // 2
+        left = (i % columns)*tile + (tile - image.shape[1]) // 2
+        mosaic[top:top + image.shape[0], left:left + image.shape[1]] = image
+        if text:
+            labels.append(((i // columns)*tile, (i % columns)*tile, os.path.split(dcm)[1]))
+    write_preview(outname, mosaic, labels = labels)
+    return failures
+
+def _convert_file(job):
+    ''' Convert a dicom for iter_convert: job is (dcm, outname, options), the
+        options being the keyword arguments of render_preview if options['fast'],
+        else of convert_dicom_to_figure, and with a preview cache (see
+        preview_cache.py) options['cache'] and options['cache_size'] (bytes).
+
+        :returns: (dcm, outname, error, cached), error being None on success,
+            else the last line of the traceback, and cached True if the preview
+            was found in the cache.
+    '''
+    dcm, outname, options = job
+    options = dict(options)
+    cache = options.pop('cache', None)
+    cache_size = options.pop('cache_size', None)
+    try:
+        if cache is not None:
+            import preview_cache
+
+            params = dict(options, format = os.path.splitext(outname)[1][1:])
+            params.pop('seg_cache', None)
+            if not options['fast'] or options['text']:
+                # the file name is drawn
+                params['name'] = os.path.split(dcm)[1]
+            key = preview_cache.cache_key(dcm, params)
+            if preview_cache.get_preview(cache, key, outname):
+                return dcm, outname, None, True
+        if options.pop('fast'):
+            render_preview(dcm, outname, **options)
+        else:
+            convert_dicom_to_figure(dcm, outname, **options)
+        if cache is not None:
+            preview_cache.put_preview(cache, key, outname, max_size = cache_size)
+    except Exception:
+        return dcm, outname, tb.format_exc().strip().splitlines()[-1], False
+    return dcm, outname, None, False
+
+def iter_convert(work, jobs = 1, chunksize = 4):
+    ''' Convert dicoms, serially or in a pool of processes using the Agg backend.
+
+        :param work: A list of (dcm, outname, options), see _convert_file.
+        :type work: list
+        :param jobs: Number of processes.
+        :type jobs: int
+        :param chunksize: Number of files sent to a process at a time.
+        :type chunksize: int
+        :returns: A generator of (dcm, outname, error, cached), in the order of work.
+    '''
+    if jobs <= 1:
+        for job in work:
+            yield _convert_file(job)
+        return
+
+    from multiprocessing import Pool
+
+    pool = Pool(processes = jobs, initializer = use_agg)
+    try:
+        for result in pool.imap(_convert_file, work, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
 
@@ -122,18 +455,72 @@ def create_parser():
                         dest = 'collage',
                         default = False,
                         action = 'store_true',
-                        help = 'Create collage for multiple images.')
+                        help = 'Create collage for multiple images, as a mosaic of --tile tiles (png, jpg or tif), or as a matplotlib figure with --mammogram or other formats.')
     parser.add_argument('-m', '--mammogram',
                         dest = 'mammo',
                         default = False,
                         action = 'store_true',
                         help = 'Indicate the image is a mammogram. Pectoral segmentation will be applied.')
+    parser.add_argument('--seg_cache',
+                        dest = 'seg_cache',
+                        default = None,
+                        action = 'store',
+                        type = str,
+                        help = 'Breast segmentation cache directory for --mammogram: segmentations are read from their sidecars there, or saved there. See mammogram_segmentation.py precompute.')
     parser.add_argument('--dpi',
                         dest = 'dpi',
                         default = 100,
                         action = 'store',
                         type = int,
                         help = 'Resolution for the output figure. Default: 100.')
+    parser.add_argument('--fast',
+                        dest = 'fast',
+                        default = False,
+                        action = 'store_true',
+                        help = 'Render previews directly, without matplotlib: windowed, downsampled to --size and written as 8-bit %s. Not for --mammogram. Default: False' % (', '.join(_preview_formats)))
+    parser.add_argument('--size',
+                        dest = 'size',
+                        default = 1024,
+                        action = 'store',
+                        type = int,
+                        help = 'Largest side of the --fast previews in pixels. Default: 1024.')
+    parser.add_argument('--no_text',
+                        dest = 'text',
+                        default = True,
+                        action = 'store_false',
+                        help = 'Do not draw the file names over the --fast previews or the --collage mosaic.')
+    parser.add_argument('--grid',
+                        dest = 'grid',
+                        default = None,
+                        action = 'store',
+                        type = int,
+                        nargs = 2,
+                        metavar = ('ROWS', 'COLUMNS'),
+                        help = 'Grid of the --collage mosaic. Default: the most square grid for the number of images.')
+    parser.add_argument('--tile',
+                        dest = 'tile',
+                        default = 512,
+                        action = 'store',
+                        type = int,
+                        help = 'Side of the tiles of the --collage mosaic in pixels. Default: 512.')
+    parser.add_argument('--cache',
+                        dest = 'cache',
+                        default = None,
+                        action = 'store',
+                        type = str,
+                        help = 'Preview cache directory. Previews are copied from it when their dicom (by SOPInstanceUID) was rendered before with the same options, and stored in it otherwise. Not for --collage. See preview_cache.py.')
+    parser.add_argument('--cache_size',
+                        dest = 'cache_size',
+                        default = 1024,
+                        action = 'store',
+                        type = float,
+                        help = 'Maximum size of the --cache in MB; the least recently used previews are removed beyond it. Default: 1024.')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of processes to convert images in parallel. Not for --collage. Default: 1.')
     return parser
     
     
@@ -143,6 +530,12 @@ def main(argv = None):
     # parse input from command line
     parser = create_parser()
     args = parser.parse_args(argv)
+    if args.fast and args.mammo:
+        parser.error('--fast cannot be used with --mammogram.')
+    if args.fast and args.format not in _preview_formats:
+        parser.error('--fast writes %s only.' % (', '.join(_preview_formats)))
+    if args.jobs > 1 and args.collage:
+        parser.error('--jobs cannot be used with --collage.')
     
     import socket, time
 
@@ -177,21 +570,48 @@ def main(argv = None):
     else:
         odir = args.odir
     
+    # figures are only saved to files
+    use_agg()
     if args.collage:
         _, tail = os.path.split(head)
         outname = os.path.join(odir, '%s_collage.%s' % (tail, args.format))
         print "Creating collage for %d images in %s" % (num_img, head)
-        status = create_collage(dcms, outname, mammogram = args.mammo, dpi=args.dpi)
-    else:
-        for i, dcm in enumerate(dcms):
-            _, tail = os.path.split(dcm)
-            outname = os.path.join(odir, "%s.%s" % (tail, args.format))
-            print "%d/%d: %s -> %s\n" % (i+1, num_img, dcm, outname)
+        if args.mammo or args.format not in _preview_formats:
+            status = create_collage(dcms, outname, mammogram = args.mammo, dpi=args.dpi, seg_cache = args.seg_cache)
+        else:
             try:
-                convert_dicom_to_figure(dcm, outname, mammogram = args.mammo, dpi=args.dpi)
-            except:
-                tb.print_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
-                pass
+                failures = create_mosaic(dcms, outname, grid = args.grid, tile = args.tile, text = args.text)
+            except ValueError as e:
+                parser.error(str(e))
+            if failures:
+                print "%d of %d images failed:" % (len(failures), num_img)
+                for dcm, error in failures:
+                    print "%s: %s" % (dcm, error)
+                return 1
+    else:
+        if args.fast:
+            options = dict(fast = True, size = args.size, text = args.text)
+        else:
+            options = dict(fast = False, mammogram = args.mammo, dpi = args.dpi, seg_cache = args.seg_cache)
+        if args.cache is not None:
+            options.update(cache = os.path.abspath(args.cache), cache_size = int(args.cache_size*1024*1024))
+        work = [(dcm, os.path.join(odir, "%s.%s" % (os.path.split(dcm)[1], args.format)), options)
+                for dcm in dcms]
+        failures = []
+        num_cached = 0
+        for i, (dcm, outname, error, cached) in enumerate(iter_convert(work, jobs = args.jobs)):
+            print "%d/%d: %s -> %s%s" % (i+1, num_img, dcm, outname,
+                                         ' failed' if error is not None else ' (cached)' if cached else '')
+            if error is not None:
+                failures.append((dcm, error))
+            num_cached += cached
+        if args.cache is not None:
+            print "%d of %d previews from the cache" % (num_cached, num_img)
+        if failures:
+            print "%d of %d images failed:" % (len(failures), num_img)
+            for dcm, error in failures:
+                print "%s: %s" % (dcm, error)
+            return 1
 
     return 0
 
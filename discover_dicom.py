@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'discover_dicom.py'
+
+import sys, os
+import struct
+
+try:  # Python 3.5+
+    from os import scandir
+except ImportError:
+    try:  # the scandir package backports it
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_preamble_length = 128
+_magic = b'DICM'
+## The file name of a media directory, which the standard fixes
+_dicomdir = 'DICOMDIR'
+
+def is_dicom(path, force = False):
+    ''' Check whether a file is a DICOM file from its first bytes, without parsing it.
+
+        A DICOM file has a 128-byte preamble followed by the DICM marker. With
+        force, files without the preamble are also accepted if they start with
+        a group 0x0002 or 0x0008 element, as written by some old devices.
+
+        :param path: Path to a file.
+        :type path: str
+        :param force: Also accept files without preamble.
+        :type force: boolean
+        :returns: True if the file looks like a DICOM file.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(_preamble_length + len(_magic))
+    except IOError:
+        return False
+    if head[_preamble_length:] == _magic:
+        return True
+    if force and len(head) >= 8:
+        group, elem = struct.unpack('<HH', head[:4])
+        return group in (0x0002, 0x0008) and elem < 0x1000
+    return False
+
+def _list_dir(input_dir):
+    ''' Return (name, path, is_file, is_dir) of the entries in input_dir. '''
+    if scandir is not None:
+        for entry in scandir(input_dir):
+            yield entry.name, entry.path, entry.is_file(), entry.is_dir(follow_symlinks = False)
+    else:
+        for name in os.listdir(input_dir):
+            path = os.path.join(input_dir, name)
+            yield name, path, os.path.isfile(path), os.path.isdir(path) and not os.path.islink(path)
+
+def discover_dicom(input_dir, recursive = False, force = False):
+    ''' Generate the DICOM files found in a given directory.
+
+        Hidden files and directories and DICOMDIR files are ignored. Every
+        other file is checked with is_dicom, so thumbnails, reports and other
+        files in an export are skipped without being parsed. Files are
+        returned in directory order.
+
+        :param input_dir: An input directory to discover dicom files.
+        :type input_dir: str
+        :param recursive: Also search the subdirectories.
+        :type recursive: boolean
+        :param force: Also accept files without preamble (see is_dicom).
+        :type force: boolean
+        :returns: A generator of paths of DICOM files.
+    '''
+    subdirs = []
+    for name, path, is_file, is_dir in _list_dir(input_dir):
+        if name[0] == '.' or name.upper() == _dicomdir:
+            continue
+        if is_file:
+            if is_dicom(path, force = force):
+                yield path
+        elif is_dir and recursive:
+            subdirs.append(path)
+    for subdir in subdirs:
+        for path in discover_dicom(subdir, recursive = True, force = force):
+            yield path
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'List the DICOM files in a directory, e.g. as an input list for read_dicom_header.py -l.')
+    # Required
+    parser.add_argument('-d', '--input_dir',
+                        required = True,
+                        dest = 'inputdir',
+                        action = 'store',
+                        type = str,
+                        help = 'Input directory')
+
+    # Optional
+    parser.add_argument('-r', '--recursive',
+                        dest = 'recursive',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Find dicoms recursively. Default: False')
+    parser.add_argument('--force',
+                        dest = 'force',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Also list files without the 128-byte preamble and DICM marker. Default: False')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    args = create_parser().parse_args(argv)
+
+    for path in discover_dicom(args.inputdir, recursive = args.recursive, force = args.force):
+        print path
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'header_index.py'
+
+import sys, os
+import time
+import zlib
+import sqlite3
+from io import BytesIO
+
+from read_dicom_header import read_header
+from discover_dicom import discover_dicom
+
+## A local SQLite index of dicom headers. Each entry holds the bytes of a
+## file up to the pixel data (compressed), validated by the size and
+## modification time of the file, so that a header can be parsed again from
+## the index instead of being read from a (network) filesystem.
+
+_deflated = '1.2.840.10008.1.2.1.99'
+
+## Open indexes of this process, by path.
+_indexes = {}
+
+def open_index(index):
+    ''' Open (or create) a header index.
+
+        Connections are kept per process, so that calling it for every file,
+        e.g. from pool workers, opens the index only once.
+
+        :param index: Path to the index file.
+        :type index: str
+        :returns: A sqlite3.Connection.
+    '''
+    index = os.path.abspath(index)
+    if index not in _indexes:
+        conn = sqlite3.connect(index, timeout = 60)
+        # WAL allows one writer alongside readers from other processes
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, '
+                     'mtime REAL, header BLOB)')
+        conn.commit()
+        _indexes[index] = conn
+    return _indexes[index]
+
+def close_index(index):
+    ''' Close a header index opened by open_index. '''
+    conn = _indexes.pop(os.path.abspath(index), None)
+    if conn is not None:
+        conn.close()
+
+def _read_header_bytes(dcm):
+    ''' Return the bytes of dcm up to the pixel data, or None if the header
+        cannot be cached (deflated transfer syntax).
+    '''
+    with open(dcm, 'rb') as fp:
+        ds = read_header(fp, defer_size = None)
+        if ds.file_meta.get('TransferSyntaxUID', None) == _deflated:
+            return None
+        end = fp.tell()
+        fp.seek(0)
+        return fp.read(end)
+
+def update_entry(conn, dcm, st = None):
+    ''' Read the header of dcm from the file and store it in the index.
+
+        :returns: The header bytes, or None if not cacheable.
+    '''
+    if st is None:
+        st = os.stat(dcm)
+    raw = _read_header_bytes(dcm)
+    if raw is not None:
+        conn.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                     (os.path.abspath(dcm), st.st_size, st.st_mtime,
+                      sqlite3.Binary(zlib.compress(raw, 1))))
+        conn.commit()
+    return raw
+
+def get_header_bytes(conn, dcm, st = None):
+    ''' Return the cached header bytes of dcm if the entry is fresh, else None. '''
+    if st is None:
+        st = os.stat(dcm)
+    row = conn.execute('SELECT size, mtime, header FROM headers WHERE path = ?',
+                       (os.path.abspath(dcm),)).fetchone()
+    if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime):
+        return None
+    return zlib.decompress(row[2])
+
+def read_header_cached(dcm, tags = None, index = None, defer_size = 1024, force = False):
+    ''' Read the header of a dicom like read_dicom_header.read_header, from the
+        header index when its entry is fresh.
+
+        A missing or stale entry is read from the file and stored.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param tags: DICOM keywords or tags needed. None to read up to the pixel data.
+        :type tags: list
+        :param index: Path to the index file. None to read from the file only.
+        :type index: str
+        :returns: A dicom.dataset.FileDataset.
+    '''
+    if index is None:
+        return read_header(dcm, tags, defer_size = defer_size, force = force)
+
+    conn = open_index(index)
+    st = os.stat(dcm)
+    raw = get_header_bytes(conn, dcm, st)
+    if raw is None:
+        raw = update_entry(conn, dcm, st)
+    if raw is None:
+        return read_header(dcm, tags, defer_size = defer_size, force = force)
+    # values are in memory already, nothing to defer
+    return read_header(BytesIO(raw), tags, defer_size = None, force = force)
+
+def update_index(index, dcms, rebuild = False):
+    ''' Add or refresh the index entries of dcms.
+
+        :param index: Path to the index file.
+        :type index: str
+        :param dcms: An iterable of paths to dicom files.
+        :param rebuild: Read every file again even if its entry is fresh.
+        :type rebuild: boolean
+        :returns: A tuple of (number of entries updated, number of files skipped
+            as invalid, unreadable or not cacheable).
+    '''
+    conn = open_index(index)
+    num_updated = 0
+    num_skipped = 0
+    for dcm in dcms:
+        try:
+            st = os.stat(dcm)
+            if not rebuild and get_header_bytes(conn, dcm, st) is not None:
+                continue
+            if update_entry(conn, dcm, st) is not None:
+                num_updated += 1
+            else:
+                num_skipped += 1
+        except sqlite3.Error:
+            raise
+        except Exception as e:
+            # invalid, truncated or unreadable; the other files are still indexed
+            print "Skipped %s: %s: %s" % (dcm, type(e).__name__, e)
+            num_skipped += 1
+    return num_updated, num_skipped
+
+def prune_index(index):
+    ''' Remove the entries of files that are missing or changed since indexed.
+
+        :returns: Number of entries removed.
+    '''
+    conn = open_index(index)
+    stale = []
+    for path, size, mtime in conn.execute('SELECT path, size, mtime FROM headers'):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stale.append((path,))
+            continue
+        if (st.st_size, st.st_mtime) != (size, mtime):
+            stale.append((path,))
+    conn.executemany('DELETE FROM headers WHERE path = ?', stale)
+    conn.commit()
+    conn.execute('VACUUM')
+    return len(stale)
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Maintain a header index used by read_dicom_header.py, sortdicom.py and show_dicomdir.py (--index) to skip reading dicom headers again.')
+    # Required
+    parser.add_argument('-x', '--index',
+                        required = True,
+                        dest = 'index',
+                        action = 'store',
+                        type = str,
+                        help = 'Header index file.')
+    parser.add_argument('command',
+                        choices = ['update', 'rebuild', 'prune'],
+                        help = 'update: index the new or changed files in the input directories; rebuild: read every file in the input directories again; prune: remove the entries of missing or changed files.')
+
+    # Optional
+    parser.add_argument('-d', '--input_dir',
+                        dest = 'inputdirs',
+                        action = 'store',
+                        default = [],
+                        nargs = '+',
+                        type = str,
+                        help = 'Input directories of dicom, searched recursively.')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    import socket
+
+    exe_folder = os.getcwd()
+    exe_time = time.strftime("%Y-%m-%d %a %H:%M:%S", time.localtime())
+    host = socket.gethostname()
+    print "Command", __EXEC__
+    print "Arguments", args
+    print "Executing on", host
+    print "Executing at", exe_time
+    print "Executing in", exe_folder
+
+    start = time.time()
+    if args.command == 'prune':
+        print "%d entries removed" % (prune_index(args.index))
+    else:
+        if not args.inputdirs:
+            parser.error('%s requires -d/--input_dir.' % args.command)
+        for inputdir in args.inputdirs:
+            num_updated, num_skipped = update_index(args.index, discover_dicom(inputdir, recursive = True),
+                                                    rebuild = args.command == 'rebuild')
+            print "%s: %d entries updated, %d invalid, unreadable or deflated dicoms skipped" % (inputdir, num_updated, num_skipped)
+    close_index(args.index)
+    end = time.time()
+    print "Elaspsed time: %.1f s" % (end-start)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'mammogram_segmentation.py'
+
+import sys, os
+import time
+import hashlib
+import traceback as tb
+import numpy as np
+
+from discover_dicom import discover_dicom
+
+## A cache of the breast segmentations drawn by convert_dicom_to_figure.py
+## --mammogram. The standardized image downsampled to 1/4, the breast mask and
+## its contours are saved per dicom as a compressed .npz sidecar in a cache
+## directory, keyed by the path, size and modification time of the dicom and
+## the version of libra, so a figure only draws the cached contours.
+
+def libra_version():
+    ''' Return the version of libra, which the sidecars depend on. '''
+    import libra
+
+    return str(getattr(libra, '__version__', 'unknown'))
+
+def segment_mammogram(dcm):
+    ''' Standardize a mammogram and segment the breast with libra.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :returns: A tuple of (image, mask, contours): the standardized image
+            downsampled to 1/4, the breast mask, and a list of the (row, column)
+            points of each contour of the mask.
+    '''
+    import libra
+    from skimage.transform import resize
+    from skimage.measure import find_contours
+
+    m = libra.io.read_image(dcm)
+    m_out = libra.preprocessing.standardize_intensity(libra.preprocessing.standardize_orientation(m))
+    image = resize(m_out.image, np.array(m_out.image.shape)/4, preserve_range=True)
+    mask, breast = libra.segmentation.segment_breast(image, pecseg=m_out.IsMLO)
+    contours = find_contours(mask, 0.8)
+    return image, mask, contours
+
+def sidecar_path(cache_dir, dcm, st = None, version = None):
+    ''' Return the path of the sidecar of a dicom in a cache directory.
+
+        :param st: os.stat of dcm, if known.
+        :param version: libra_version(), if known.
+    '''
+    if st is None:
+        st = os.stat(dcm)
+    if version is None:
+        version = libra_version()
+    key = hashlib.sha1('%s\n%d\n%r\n%s' % (os.path.abspath(dcm), st.st_size, st.st_mtime, version)).hexdigest()
+    # spread over 256 subdirectories
+    return os.path.join(cache_dir, key[:2], key + '.npz')
+
+def save_segmentation(fname, image, mask, contours):
+    ''' Save a segmentation as a compressed .npz, written to a temporary file
+        first so readers never see a partial sidecar.
+    '''
+    head, tail = os.path.split(fname)
+    if not os.path.isdir(head):
+        try:
+            os.makedirs(head)
+        except OSError:
+            # created by another process meanwhile
+            if not os.path.isdir(head):
+                raise
+    if len(contours) > 0:
+        points = np.concatenate(contours).astype(np.float32)
+    else:
+        points = np.zeros((0, 2), dtype = np.float32)
+    tmp = os.path.join(head, '.%s.%d.tmp' % (tail, os.getpid()))
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, image = image.astype(np.float32), mask = mask.astype(bool),
+                            points = points, lengths = np.array([len(c) for c in contours], dtype = np.int64))
+    os.rename(tmp, fname)
+
+def load_segmentation(fname):
+    ''' Load a segmentation saved by save_segmentation.
+
+        :returns: A tuple of (image, mask, contours), like segment_mammogram.
+    '''
+    with np.load(fname) as npz:
+        image, mask, points, lengths = npz['image'], npz['mask'], npz['points'], npz['lengths']
+    contours = np.split(points, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+    return image, mask, contours
+
+def touch(fname):
+    ''' Mark a sidecar as used now, for prune. The modification time is set,
+        as the access time is not updated on noatime or relatime mounts.
+    '''
+    try:
+        os.utime(fname, None)
+    except OSError:
+        # pruned by another process meanwhile
+        pass
+
+def cached_segmentation(dcm, cache_dir = None):
+    ''' Return the segmentation of a mammogram from its sidecar, segmenting it
+        and saving the sidecar if there is none.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param cache_dir: The cache directory. None to segment without cache.
+        :type cache_dir: str
+        :returns: A tuple of (image, mask, contours), see segment_mammogram.
+    '''
+    if cache_dir is None:
+        return segment_mammogram(dcm)
+    fname = sidecar_path(cache_dir, dcm)
+    if os.path.isfile(fname):
+        segmentation = load_segmentation(fname)
+        touch(fname)
+        return segmentation
+    image, mask, contours = segment_mammogram(dcm)
+    save_segmentation(fname, image, mask, contours)
+    return image, mask, contours
+
+def _precompute_file(job):
+    ''' Save the sidecar of a dicom for precompute if missing: job is (dcm, cache_dir, version).
+
+        :returns: (dcm, error, computed), error being None on success, else the
+            last line of the traceback.
+    '''
+    dcm, cache_dir, version = job
+    try:
+        fname = sidecar_path(cache_dir, dcm, version = version)
+        if os.path.isfile(fname):
+            touch(fname)
+            return dcm, None, False
+        save_segmentation(fname, *segment_mammogram(dcm))
+    except Exception:
+        return dcm, tb.format_exc().strip().splitlines()[-1], False
+    return dcm, None, True
+
+def precompute(cache_dir, dcms, jobs = 1, chunksize = 1):
+    ''' Save the missing sidecars of dicoms, in a pool of processes.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        :param dcms: An iterable of paths to dicom files.
+        :param jobs: Number of processes.
+        :type jobs: int
+        :param chunksize: Number of files sent to a process at a time.
+        :type chunksize: int
+        :returns: A generator of (dcm, error, computed), see _precompute_file,
+            in no particular order.
+    '''
+    version = libra_version()
+    work = ((dcm, cache_dir, version) for dcm in dcms)
+    if jobs <= 1:
+        for job in work:
+            yield _precompute_file(job)
+        return
+
+    from multiprocessing import Pool
+
+    pool = Pool(processes = jobs)
+    try:
+        # segmentation times vary, the order does not matter
+        for result in pool.imap_unordered(_precompute_file, work, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def prune(cache_dir, max_age):
+    ''' Remove the sidecars not used (read or written) for max_age days,
+        by their modification time, see touch.
+
+        Sidecars of changed files or of another libra version are never read
+        again, so they are removed once old enough.
+
+        :returns: Number of sidecars removed.
+    '''
+    limit = time.time() - max_age*24*3600
+    num_removed = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith('.npz') and os.path.getmtime(path) < limit:
+                os.remove(path)
+                num_removed += 1
+    return num_removed
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Maintain the breast segmentation cache used by convert_dicom_to_figure.py --mammogram --seg_cache.')
+    # Required
+    parser.add_argument('-x', '--cache',
+                        required = True,
+                        dest = 'cache',
+                        action = 'store',
+                        type = str,
+                        help = 'Segmentation cache directory.')
+    parser.add_argument('command',
+                        choices = ['precompute', 'prune'],
+                        help = 'precompute: segment the mammograms in the input directories that have no sidecar yet; prune: remove the sidecars not used for --max_age days.')
+
+    # Optional
+    parser.add_argument('-d', '--input_dir',
+                        dest = 'inputdirs',
+                        action = 'store',
+                        default = [],
+                        nargs = '+',
+                        type = str,
+                        help = 'Input directories of mammograms, searched recursively.')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of processes to segment mammograms in parallel. Default: 1.')
+    parser.add_argument('--max_age',
+                        dest = 'max_age',
+                        action = 'store',
+                        default = 30,
+                        type = float,
+                        help = 'Age in days of the sidecars removed by prune. Default: 30.')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    import socket
+
+    exe_folder = os.getcwd()
+    exe_time = time.strftime("%Y-%m-%d %a %H:%M:%S", time.localtime())
+    host = socket.gethostname()
+    print "Command", __EXEC__
+    print "Arguments", args
+    print "Executing on", host
+    print "Executing at", exe_time
+    print "Executing in", exe_folder
+
+    start = time.time()
+    if args.command == 'prune':
+        print "%d sidecars removed" % (prune(args.cache, args.max_age))
+        return 0
+
+    if not args.inputdirs:
+        parser.error('precompute requires -d/--input_dir.')
+    dcms = [dcm for inputdir in args.inputdirs for dcm in discover_dicom(inputdir, recursive = True)]
+    num_computed = 0
+    failures = []
+    for i, (dcm, error, computed) in enumerate(precompute(args.cache, dcms, jobs = args.jobs)):
+        print "%d/%d: %s%s" % (i+1, len(dcms), dcm, ' failed' if error is not None else '' if computed else ' (cached)')
+        if error is not None:
+            failures.append((dcm, error))
+        num_computed += computed
+    end = time.time()
+    print "%d of %d mammograms segmented, %d cached already" % (num_computed, len(dcms), len(dcms) - num_computed - len(failures))
+    print "Elaspsed time: %.1f s" % (end-start)
+    if failures:
+        print "%d of %d mammograms failed:" % (len(failures), len(dcms))
+        for dcm, error in failures:
+            print "%s: %s" % (dcm, error)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
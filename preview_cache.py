@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+__author__ = 'HsiehM'
+__EXEC__ = 'preview_cache.py'
+
+import sys, os
+import time
+import hashlib
+import shutil
+import sqlite3
+
+from read_dicom_header import read_header
+
+## An on-disk cache of the previews written by convert_dicom_to_figure.py.
+## A preview is stored under a key made of the SOPInstanceUID of its dicom
+## (or a hash of the file if it has none), the size of the file, the elements
+## the rendering depends on, where and how long the pixel data is, and the
+## render parameters, so it is found again from the header alone, without
+## reading the pixel data, and a dicom rewritten with the same UID (e.g. with
+## another window or redacted) gets a new preview. An SQLite index in the cache directory keeps the size and last
+## use of every preview, to evict the least recently used ones once the cache
+## is larger than its maximum size.
+
+_index_name = 'index.sqlite'
+
+## Elements of the header a preview depends on, besides the pixel data.
+_identity_tags = ['SOPInstanceUID', 'Rows', 'Columns', 'NumberOfFrames', 'SamplesPerPixel',
+                  'BitsAllocated', 'BitsStored', 'PixelRepresentation', 'PhotometricInterpretation',
+                  'RescaleSlope', 'RescaleIntercept', 'WindowCenter', 'WindowWidth', 'VOILUTSequence']
+
+## Open caches of this process, by directory.
+_caches = {}
+
+def open_cache(cache_dir):
+    ''' Open (or create) a preview cache.
+
+        Connections are kept per process, so that calling it for every file,
+        e.g. from pool workers, opens the cache only once.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        :returns: A sqlite3.Connection to the index of the cache.
+    '''
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _caches:
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another process meanwhile
+                if not os.path.isdir(cache_dir):
+                    raise
+        conn = sqlite3.connect(os.path.join(cache_dir, _index_name), timeout = 60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS previews (key TEXT PRIMARY KEY, name TEXT, size INTEGER, used REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS previews_used ON previews (used)')
+        conn.commit()
+        _caches[cache_dir] = conn
+    return _caches[cache_dir]
+
+def _file_hash(dcm, buffer_size = 1024*1024):
+    ''' Return the SHA-1 of a file, in hex. '''
+    sha = hashlib.sha1()
+    with open(dcm, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cache_key(dcm, params):
+    ''' Return the cache key of the preview of a dicom, from its header only.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param params: Everything the preview depends on besides the image,
+            e.g. format, dpi, size, mammogram mode and the text drawn.
+        :type params: dict
+        :returns: A hex digest.
+    '''
+    with open(dcm, 'rb') as fp:
+        ds = read_header(fp, defer_size = None)
+        # read_header stops at the start of the pixel data element; its tag,
+        # VR and length (undefined if encapsulated) come next
+        offset = fp.tell()
+        pixel_header = fp.read(12)
+        size = os.fstat(fp.fileno()).st_size
+    uid = str(ds.get('SOPInstanceUID', '')).rstrip('\x00').strip()
+    if not uid:
+        uid = 'sha1:' + _file_hash(dcm)
+    identity = [(tag, repr(getattr(ds, tag, None))) for tag in _identity_tags]
+    return hashlib.sha1('%s\n%d\n%d\n%r\n%r\n%r' % (uid, size, offset, pixel_header, identity,
+                                                      sorted(params.items()))).hexdigest()
+
+def get_preview(cache_dir, key, outname):
+    ''' Copy a cached preview to outname if there is one, and mark it as used.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        :param key: The key of the preview, see cache_key.
+        :type key: str
+        :param outname: Output file. Its extension is the format of the preview.
+        :type outname: str
+        :returns: True on a hit, False on a miss.
+    '''
+    conn = open_cache(cache_dir)
+    row = conn.execute('SELECT name FROM previews WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return False
+    try:
+        shutil.copyfile(os.path.join(cache_dir, row[0]), outname)
+    except IOError:
+        # evicted by another process meanwhile
+        return False
+    conn.execute('UPDATE previews SET used = ? WHERE key = ?', (time.time(), key))
+    conn.commit()
+    return True
+
+def put_preview(cache_dir, key, fname, max_size = None):
+    ''' Store a preview in the cache, then evict the least recently used
+        previews if the cache is larger than max_size.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        :param key: The key of the preview, see cache_key.
+        :type key: str
+        :param fname: The preview. Its extension is its format.
+        :type fname: str
+        :param max_size: Maximum size of the cache in bytes. None for no limit.
+        :type max_size: int
+    '''
+    conn = open_cache(cache_dir)
+    # spread over 256 subdirectories
+    name = os.path.join(key[:2], key + os.path.splitext(fname)[1])
+    cached = os.path.join(cache_dir, name)
+    head, tail = os.path.split(cached)
+    if not os.path.isdir(head):
+        try:
+            os.makedirs(head)
+        except OSError:
+            if not os.path.isdir(head):
+                raise
+    # readers never see a partial file
+    tmp = os.path.join(head, '.%s.%d.tmp' % (tail, os.getpid()))
+    shutil.copyfile(fname, tmp)
+    os.rename(tmp, cached)
+    conn.execute('INSERT OR REPLACE INTO previews VALUES (?, ?, ?, ?)', (key, name, os.path.getsize(cached), time.time()))
+    conn.commit()
+    if max_size is not None:
+        evict(cache_dir, max_size)
+
+def evict(cache_dir, max_size):
+    ''' Remove the least recently used previews until the cache is at most max_size bytes.
+
+        :returns: Number of previews removed.
+    '''
+    conn = open_cache(cache_dir)
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM previews').fetchone()[0]
+    if total <= max_size:
+        return 0
+    removed = []
+    for key, name, size in conn.execute('SELECT key, name, size FROM previews ORDER BY used'):
+        if total <= max_size:
+            break
+        removed.append((key, name))
+        total -= size
+    for key, name in removed:
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            # removed by another process meanwhile
+            pass
+    conn.executemany('DELETE FROM previews WHERE key = ?', [(key,) for key, name in removed])
+    conn.commit()
+    return len(removed)
+
+def cache_stats(cache_dir):
+    ''' Return (number of previews, total size in bytes) of a cache. '''
+    return open_cache(cache_dir).execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM previews').fetchone()
+
+def create_parser():
+    import argparse
+    ''' Create an argparse.ArgumentParser object
+
+        :returns: An argparse.ArgumentParser parser.
+    '''
+    parser = argparse.ArgumentParser(prog = __EXEC__,
+                                     description = 'Maintain a preview cache written by convert_dicom_to_figure.py --cache.')
+    # Required
+    parser.add_argument('-x', '--cache',
+                        required = True,
+                        dest = 'cache',
+                        action = 'store',
+                        type = str,
+                        help = 'Cache directory.')
+    parser.add_argument('command',
+                        choices = ['stats', 'evict', 'clear'],
+                        help = 'stats: print the number and size of the cached previews; evict: remove the least recently used previews down to --max_size; clear: remove every preview.')
+
+    # Optional
+    parser.add_argument('--max_size',
+                        dest = 'max_size',
+                        action = 'store',
+                        default = 1024,
+                        type = float,
+                        help = 'Maximum size of the cache in MB, for evict. Default: 1024.')
+    return parser
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # parse input from command line
+    args = create_parser().parse_args(argv)
+
+    if args.command == 'evict':
+        print "%d previews removed" % (evict(args.cache, int(args.max_size*1024*1024)))
+    elif args.command == 'clear':
+        print "%d previews removed" % (evict(args.cache, 0))
+    num, size = cache_stats(args.cache)
+    print "%d previews, %.1f MB" % (num, size/1024./1024.)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
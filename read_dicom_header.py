@@ -4,11 +4,15 @@ __EXEC__ = 'read_dicom_header.py'
 
 import sys, os
 import time
-from glob import glob
+import csv
+import tempfile
+import datetime
+import cPickle as pickle
+from itertools import islice
 from collections import OrderedDict
 import dicom 
+from discover_dicom import discover_dicom
 import numpy as np
-import pandas as pd
 
 def create_parser():
     import argparse
@@ -24,7 +28,7 @@ def create_parser():
                         dest = 'outputcsv',
                         action = 'store',
                         type = str,
-                        help = 'Output CSV')
+                        help = 'Output CSV, or Parquet/Arrow file (see -f)')
     
     # Optional
     parser.add_argument('-i', '--input_dcm',
@@ -45,16 +49,129 @@ def create_parser():
                         action = 'store',
                         default = None,
                         type = str,
-                        help = 'Input a directory of dicom')
+                        help = 'Input a directory of dicom. Only files with the DICM marker are read (see --force).')
+    parser.add_argument('-t', '--tags',
+                        dest = 'tags',
+                        action = 'store',
+                        default = None,
+                        nargs = '+',
+                        type = str,
+                        help = 'Only collect these fields, given as DICOM keywords (e.g. AccessionNumber) or hex tags (e.g. 0x00080050). Parsing stops after the last requested tag. Default: all fields.')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of processes to read dicom headers. Default: 1.')
+    parser.add_argument('--chunksize',
+                        dest = 'chunksize',
+                        action = 'store',
+                        default = 64,
+                        type = int,
+                        help = 'Number of dicoms sent to a process at a time. Default: 64.')
+    parser.add_argument('-f', '--format',
+                        dest = 'format',
+                        action = 'store',
+                        default = None,
+                        choices = ['csv', 'parquet', 'arrow'],
+                        type = str,
+                        help = 'Output format. parquet and arrow (Arrow IPC file, not Feather) have typed columns derived from the VR and require pyarrow. Default: guessed from the output extension (.parquet/.pq, .arrow), else csv.')
+    parser.add_argument('--row_group_size',
+                        dest = 'row_group_size',
+                        action = 'store',
+                        default = 10000,
+                        type = int,
+                        help = 'Number of rows per row group (parquet) or record batch (arrow). Default: 10000.')
+    parser.add_argument('-x', '--index',
+                        dest = 'index',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'Header index file (see header_index.py). Headers are read from the index when it is up to date with the file, and added to it otherwise. Default: none.')
+    parser.add_argument('--force',
+                        dest = 'force',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Also read files without the 128-byte preamble and DICM marker. Default: False')
     return parser
 
 
-def collect_dicom_header(dcm):
+_pixel_data_tag = 0x7fe00010
+
+def parse_tag(tag):
+    ''' Convert a DICOM keyword or a hex string into a tag.
+
+        :param tag: A DICOM keyword (e.g. AccessionNumber), a hex string (e.g. 0x00080050) or a tag.
+        :type tag: str or int
+        :returns: The tag as an int.
+    '''
+    if not isinstance(tag, basestring):
+        return int(tag)
+    t = dicom.datadict.tag_for_name(tag)
+    if t is None:
+        try:
+            t = int(tag, 16)
+        except ValueError:
+            raise ValueError('%s is neither a DICOM keyword nor a hex tag.' % tag)
+    return int(t)
+
+def read_header(dcm, tags = None, defer_size = 1024, force = False):
+    ''' Read the header of a dicom, parsing only as far as the requested tags.
+
+        The file meta information is always read. The dataset is parsed until
+        the first element past the highest requested tag (or the pixel data),
+        and values larger than defer_size bytes are only read when accessed.
+
+        :param dcm: Path to a dicom file, or a file-like object.
+        :type dcm: str
+        :param tags: DICOM keywords or tags needed. None to read up to the pixel data.
+        :type tags: list
+        :param defer_size: Values larger than this (bytes) are read on access. None to read all values.
+        :type defer_size: int
+        :param force: Read the file even if the DICM header is missing.
+        :type force: boolean
+        :returns: A dicom.dataset.FileDataset.
+    '''
+    if tags is None:
+        last_tag = _pixel_data_tag - 1
+    else:
+        last_tag = min(max(parse_tag(t) for t in tags), _pixel_data_tag - 1)
+
+    def stop_when(tag, VR, length):
+        return tag > last_tag
+
+    if not isinstance(dcm, basestring):
+        # a file-like object, e.g. a cached header in memory
+        return dicom.filereader.read_partial(dcm, stop_when, defer_size = defer_size, force = force)
+    with open(dcm, 'rb') as fp:
+        return dicom.filereader.read_partial(fp, stop_when, defer_size = defer_size, force = force)
+
+def collect_dicom_elements(dcm, tags = None, index = None, force = False):
+    ''' Collect the data elements of a dicom header into an OrderedDict keyed by field name.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param tags: DICOM keywords or tags to collect. None to collect all fields.
+        :type tags: list
+        :param index: Path to a header index (see header_index.py) to read the header from when fresh.
+        :type index: str
+        :param force: Read the file even if the DICM header is missing.
+        :type force: boolean
+        :returns: An OrderedDict of field name to dicom.dataelem.DataElement. Empty if dcm is not readable.
+    '''
 
     d = OrderedDict()
+    if tags is not None:
+        tags = set(parse_tag(t) for t in tags)
 
     try:
-        ds = dicom.read_file(dcm, stop_before_pixels = True)
+        if index is not None:
+            from header_index import read_header_cached
+            ds = read_header_cached(dcm, tags, index = index, defer_size = None, force = force)
+        elif tags is None:
+            ds = read_header(dcm, defer_size = None, force = force)
+        else:
+            ds = read_header(dcm, tags, force = force)
     except dicom.errors.InvalidDicomError:
         print '%s is not a valid dicom.' % (dcm)
         return d
@@ -63,21 +180,289 @@ def collect_dicom_header(dcm):
         return d
         
     for k in ds.file_meta.keys():
+        if tags is not None and k not in tags:
+            continue
         if "unknown" not in ds.file_meta[k].name.lower():
-            d[ds.file_meta[k].name] = ds.file_meta[k].value
+            d[ds.file_meta[k].name] = ds.file_meta[k]
 
     for k in ds.keys():
+        if tags is not None and k not in tags:
+            continue
         if "unknown" not in ds[k].name.lower():
-            d[ds[k].name] = ds[k].value
+            d[ds[k].name] = ds[k]
     
     return d
 
+def collect_dicom_header(dcm, tags = None, index = None):
+    ''' Collect the fields of a dicom header into an OrderedDict keyed by field name.
+
+        :param dcm: Path to a dicom file.
+        :type dcm: str
+        :param tags: DICOM keywords or tags to collect. None to collect all fields.
+        :type tags: list
+        :param index: Path to a header index (see header_index.py) to read the header from when fresh.
+        :type index: str
+        :returns: An OrderedDict of field name to value. Empty if dcm is not readable.
+    '''
+    d = collect_dicom_elements(dcm, tags = tags, index = index)
+    for k in d:
+        d[k] = d[k].value
+    return d
+
+
+def _value_to_string(v):
+    ''' Stringify a header value the way pandas writes it to a CSV. '''
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    if isinstance(v, str):
+        # the raw string rather than e.g. the name of a UID
+        return str.__str__(v)
+    if isinstance(v, float):
+        # DS values keep the text they were read from
+        if getattr(v, 'original_string', None) is not None:
+            return str(v.original_string)
+        return repr(float(v))
+    if isinstance(v, (int, long)) and not isinstance(v, dicom.tag.BaseTag):
+        return str(int(v))
+    return str(v)
+
+def _to_date(v):
+    v = v.replace('.', '').strip()
+    return datetime.date(int(v[:4]), int(v[4:6]), int(v[6:8]))
+
+def _to_time(v):
+    v = v.replace(':', '').strip()
+    v, _, fraction = v.partition('.')
+    v = v.ljust(6, '0')
+    return datetime.time(int(v[:2]), int(v[2:4]), int(v[4:6]), int(fraction[:6].ljust(6, '0')))
+
+def _to_datetime(v):
+    v = v.strip()
+    for sign in '+-':
+        v = v.split(sign)[0]
+    v, _, fraction = v.partition('.')
+    v = v.ljust(14, '0')
+    # months and days default to 01
+    v = v[:4] + (v[4:6] if v[4:6] != '00' else '01') + (v[6:8] if v[6:8] != '00' else '01') + v[8:]
+    return datetime.datetime(int(v[:4]), int(v[4:6]), int(v[6:8]), int(v[8:10]), int(v[10:12]),
+                             int(v[12:14]), int(fraction[:6].ljust(6, '0')))
+
+def _to_unicode(v):
+    return _value_to_string(v).decode('utf-8', 'replace')
+
+## Python type of the value for each VR in typed output. Any other VR is a string.
+_vr_converters = {'IS': int, 'SL': int, 'SS': int, 'UL': int, 'US': int,
+                  'DS': float, 'FL': float, 'FD': float,
+                  'DA': _to_date, 'TM': _to_time, 'DT': _to_datetime,
+                  'OB': str, 'OW': str, 'OF': str, 'UN': str, 'OB or OW': str, 'US or SS or OW': str}
+
+def _typed_value(elem):
+    ''' Convert the value of a data element to a python type according to its VR.
+
+        :returns: A tuple of (VR, multi-valued or not, value or list of values).
+            Values that cannot be converted are None.
+    '''
+    vr = elem.VR
+    value = elem.value
+    if vr not in _vr_converters or vr == 'SQ':
+        vr = None
+        convert = _to_unicode
+    else:
+        convert = _vr_converters[vr]
+    # a Sequence is a list too
+    multi = isinstance(value, list) and elem.VR != 'SQ'
+
+    out = []
+    for v in (value if multi else [value]):
+        try:
+            out.append(None if v == '' else convert(v))
+        except (TypeError, ValueError):
+            out.append(None)
+    return vr, multi, out if multi else out[0]
+
+def _header_row(job):
+    dcm, tags, typed, index, force = job
+    d = collect_dicom_elements(dcm, tags = tags, index = index, force = force)
+    if typed:
+        return dcm, [(k,) + _typed_value(elem) for k, elem in d.iteritems()]
+    return dcm, [(k, _value_to_string(elem.value)) for k, elem in d.iteritems()]
+
+def iter_dicom_headers(dcms, tags = None, jobs = 1, chunksize = 64, typed = False, index = None,
+                       force = False):
+    ''' Collect the header fields of dicoms, in a pool of processes if jobs > 1.
+
+        The dicoms are handed out in batches, so only a few batches of paths
+        and results are held in memory at any time.
+
+        :param dcms: An iterable of paths to dicom files.
+        :param tags: DICOM keywords or tags to collect. None to collect all fields.
+        :type tags: list
+        :param jobs: Number of processes.
+        :type jobs: int
+        :param chunksize: Number of dicoms sent to a process at a time.
+        :type chunksize: int
+        :param typed: Convert the values according to their VR instead of into strings.
+        :type typed: boolean
+        :param index: Path to a header index (see header_index.py) to read the headers from when fresh.
+        :type index: str
+        :param force: Read the files even if the DICM header is missing.
+        :type force: boolean
+        :returns: A generator of (dicom, [(field name, value in string), ...]) in input order.
+            If typed, (dicom, [(field name, VR, multi-valued, value), ...]).
+    '''
+    work = ((dcm, tags, typed, index, force) for dcm in dcms)
+    if jobs <= 1:
+        for job in work:
+            yield _header_row(job)
+        return
+
+    from multiprocessing import Pool
+    batchsize = jobs * chunksize * 4
+    pool = Pool(processes = jobs)
+    try:
+        batch = list(islice(work, batchsize))
+        pending = pool.imap(_header_row, batch, chunksize) if batch else None
+        while pending is not None:
+            # queue up the next batch before draining this one to keep the pool busy
+            batch = list(islice(work, batchsize))
+            next_pending = pool.imap(_header_row, batch, chunksize) if batch else None
+            for row in pending:
+                yield row
+            pending = next_pending
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def write_header_csv(rows, outputcsv):
+    ''' Write the header fields from iter_dicom_headers to a CSV file.
+
+        Rows are spooled to a temporary file next to outputcsv while the set of
+        columns is collected in order of first appearance, then the CSV is
+        written in a second sequential pass. Memory use does not grow with the
+        number of rows. Dicoms without any field (e.g. invalid) are left out.
+
+        :returns: Number of rows written.
+    '''
+    columns = OrderedDict()
+    num_rows = 0
+    with tempfile.TemporaryFile(dir = os.path.dirname(os.path.abspath(outputcsv))) as spool:
+        for dcm, row in rows:
+            if not row:
+                continue
+            for k, v in row:
+                if k not in columns:
+                    columns[k] = len(columns)
+            pickle.dump((dcm, [(columns[k], v) for k, v in row]), spool, pickle.HIGHEST_PROTOCOL)
+            num_rows += 1
+
+        spool.seek(0)
+        with open(outputcsv, 'wb') as f:
+            writer = csv.writer(f, lineterminator = '\n')
+            writer.writerow(['Files'] + columns.keys())
+            for i in xrange(num_rows):
+                dcm, row = pickle.load(spool)
+                values = [''] * len(columns)
+                for k, v in row:
+                    values[k] = v
+                writer.writerow([dcm] + values)
+    return num_rows
+
+def _arrow_type(vr, multi):
+    import pyarrow as pa
+    t = {int: pa.int64(), float: pa.float64(), str: pa.binary(),
+         _to_date: pa.date32(), _to_time: pa.time64('us'),
+         _to_datetime: pa.timestamp('us')}.get(_vr_converters.get(vr), pa.string())
+    return pa.list_(t) if multi else t
+
+def _arrow_value(v, vr, multi):
+    ''' Fit a value from _typed_value into a column of the given VR. '''
+    if v is None:
+        return None
+    if multi and not isinstance(v, list):
+        v = [v]
+    if vr is None:
+        if multi:
+            v = [x if x is None or isinstance(x, unicode) else _to_unicode(x) for x in v]
+        elif not isinstance(v, unicode):
+            v = _to_unicode(v)
+    return v
+
+def write_header_table(rows, output, fmt = 'parquet', row_group_size = 10000):
+    ''' Write typed header fields from iter_dicom_headers(..., typed = True)
+        to a Parquet or Arrow IPC file. Requires pyarrow.
+
+        Column types follow the VR: DA, TM and DT become dates, times and
+        timestamps, IS/DS and the binary number VRs become ints and floats,
+        and multi-valued fields become lists. A field seen with different VRs
+        falls back to string. Rows are spooled to a temporary file while the
+        columns are collected, then written in row groups of row_group_size,
+        so memory use does not grow with the number of rows.
+
+        :returns: Number of rows written.
+    '''
+    import pyarrow as pa
+
+    # field name -> [column index, VR, multi-valued]
+    columns = OrderedDict()
+    num_rows = 0
+    with tempfile.TemporaryFile(dir = os.path.dirname(os.path.abspath(output))) as spool:
+        for dcm, row in rows:
+            if not row:
+                continue
+            for k, vr, multi, v in row:
+                if k not in columns:
+                    columns[k] = [len(columns), vr, multi]
+                else:
+                    col = columns[k]
+                    if col[1] != vr:
+                        col[1] = None
+                    col[2] = col[2] or multi
+            pickle.dump((dcm, [(columns[k][0], v) for k, vr, multi, v in row]), spool, pickle.HIGHEST_PROTOCOL)
+            num_rows += 1
+
+        names = ['Files'] + columns.keys()
+        types = [pa.string()] + [_arrow_type(vr, multi) for i, vr, multi in columns.values()]
+        schema = pa.schema([pa.field(n, t) for n, t in zip(names, types)])
+        specs = [(None, False)] + [(vr, multi) for i, vr, multi in columns.values()]
+
+        spool.seek(0)
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(output, schema)
+            write = lambda arrays: writer.write_table(pa.Table.from_arrays(arrays, names))
+        else:
+            sink = pa.OSFile(output, 'wb')
+            writer = pa.RecordBatchFileWriter(sink, schema)
+            write = lambda arrays: writer.write_batch(pa.RecordBatch.from_arrays(arrays, names))
+        try:
+            for start in xrange(0, num_rows, row_group_size):
+                values = [[] for n in names]
+                for i in xrange(min(row_group_size, num_rows - start)):
+                    dcm, row = pickle.load(spool)
+                    values[0].append(dcm.decode('utf-8', 'replace'))
+                    row_values = [None] * len(columns)
+                    for k, v in row:
+                        row_values[k] = v
+                    for k, v in enumerate(row_values):
+                        values[k+1].append(_arrow_value(v, *specs[k+1]))
+                write([pa.array(v, type = t) for v, t in zip(values, types)])
+        finally:
+            writer.close()
+            if fmt != 'parquet':
+                sink.close()
+    return num_rows
 
 def main(argv = None):
     if argv is None:
         argv = sys.argv[1:]
     # parse input from command line
-    args = create_parser().parse_args(argv)
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.format is None and args.outputcsv.lower().endswith('.feather'):
+        parser.error('Feather is not written; use an .arrow output (Arrow IPC file) or -f.')
 
     import socket
 
@@ -94,25 +479,28 @@ def main(argv = None):
     if args.inputdcm is not None:
         dcms_all = args.inputdcm
     elif args.inputlist is not None:
-        dcms_all = [line.strip('\n') for line in open(args.inputlist, 'r')]
+        dcms_all = (line.strip('\n') for line in open(args.inputlist, 'r'))
     elif args.inputdir is not None:
-        dcms_all = glob(os.path.join(args.inputdir, '*'))
-    print "%d dicom found" % (len(dcms_all))
+        dcms_all = discover_dicom(args.inputdir, force = args.force)
     
-    print "Collecting dicom header fields..."
+    print "Collecting dicom header fields and writing out..."
     start = time.time()
-    out_d = map(collect_dicom_header, dcms_all)
+    tags = None
+    if args.tags is not None:
+        tags = [parse_tag(t) for t in args.tags]
+    fmt = args.format
+    if fmt is None:
+        fmt = {'.parquet': 'parquet', '.pq': 'parquet',
+               '.arrow': 'arrow'}.get(os.path.splitext(args.outputcsv)[1].lower(), 'csv')
+    rows = iter_dicom_headers(dcms_all, tags = tags, jobs = args.jobs, chunksize = args.chunksize,
+                              typed = fmt != 'csv', index = args.index, force = args.force)
+    if fmt == 'csv':
+        num_rows = write_header_csv(rows, args.outputcsv)
+    else:
+        num_rows = write_header_table(rows, args.outputcsv, fmt = fmt, row_group_size = args.row_group_size)
     end = time.time()
+    print "%d dicom written" % (num_rows)
     print "Elaspsed time: %.1f s" % (end-start)
-
-    out_d_all = OrderedDict()
-    for i, f in enumerate(dcms_all):
-        out_d_all[f] = out_d[i]
-
-    print "Writing out csv..."
-    df = pd.DataFrame.from_dict(out_d_all, orient='index')
-    df.index.name = 'Files'
-    df.to_csv(args.outputcsv)
           
 if __name__ == '__main__':
     sys.exit(main())
@@ -13,6 +13,7 @@ __DOC__ ='''Example program showing DICOMDIR contents, assuming standard
 import sys, os
 import dicom
 from pprint import pprint
+from header_index import read_header_cached
 # dicom.debug()
 
 def main(argv = None):
@@ -56,7 +57,7 @@ def main(argv = None):
                     # slice_locations = [dicom.read_file(image_filename).SliceLocation
                     #                   for image_filename in image_filenames]
 
-                    datasets = [dicom.read_file(image_filename)
+                    datasets = [read_header_cached(image_filename, ['PatientName', 'PatientID'], index = args.index)
                                 for image_filename in image_filenames]
 
                     patient_names = set(ds.PatientName for ds in datasets)
@@ -98,6 +99,12 @@ def create_parser():
                         dest = 'verbosity',
                         action = 'count',
                         help = 'Increase verbosity of the program. By calling the flag multiple time, the verbosity can be further increased.')
+    parser.add_argument('-x', '--index',
+                        dest = 'index',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'Header index file (see header_index.py) to read image headers from with -v. Default: none.')
     
     return parser
 
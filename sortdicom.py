@@ -4,11 +4,27 @@ __EXEC__ = 'sortdicom.py'
 
 import sys
 import os
+import errno
 import shutil
 import warnings as w
+import traceback as tb
 import dicom
 from glob import glob
 from collections import Counter
+from StringIO import StringIO
+from read_dicom_header import parse_tag
+from header_index import read_header_cached
+from discover_dicom import discover_dicom
+
+def _makedirs( path ):
+    ''' os.makedirs that tolerates the directory being created concurrently
+        by another worker.
+    '''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
     
 def get_laterality( ds ):
     if "ImageLaterality" in ds:
@@ -103,9 +119,64 @@ def get_instance_number(ds):
         w.warn('Cannot determine instance number.', RuntimeWarning)
         return None     
         
-# TODO 20180517: to get acq date time in int so that we can sort the dicom list by time.
+def _datetime_to_int( dt ):
+    ''' Convert a DICOM DT string (YYYYMMDDHHMMSS.FFFFFF&ZZXX, trailing
+        components optional) into an int YYYYMMDDHHMMSSFFFFFF. The UTC offset
+        is ignored.
+    '''
+    dt = dt.strip().replace(':', '')
+    for sign in '+-':
+        dt = dt.split(sign)[0]
+    if '.' in dt:
+        dt, fraction = dt.split('.', 1)
+    else:
+        fraction = ''
+    if not (dt + fraction).isdigit():
+        return None
+    return int(dt[:14].ljust(14, '0') + fraction[:6].ljust(6, '0'))
+
 def get_acquisition_date_time(ds):
-    pass
+    ''' Return the acquisition date and time as an int (YYYYMMDDHHMMSSFFFFFF)
+        so that dicoms can be sorted by time.
+        Search order: AcquisitionDateTime [0x0008, 0x002A],
+        AcquisitionDate/Time [0x0008, 0x0022/0x0032],
+        ContentDate/Time [0x0008, 0x0023/0x0033].
+
+        :param ds: dicom header information.
+        :type ds: dicom.dataset.FileDataset or OrderedDict
+        :returns: The date time in int, or None if not available.
+    '''
+    if 'AcquisitionDateTime' in ds and ds.AcquisitionDateTime:
+        dt = _datetime_to_int(ds.AcquisitionDateTime)
+        if dt is not None:
+            return dt
+    for date_field, time_field in [('AcquisitionDate', 'AcquisitionTime'),
+                                   ('ContentDate', 'ContentTime')]:
+        if date_field in ds and time_field in ds and ds.data_element(date_field).value and ds.data_element(time_field).value:
+            dt = _datetime_to_int(ds.data_element(date_field).value.replace('.', '')[:8] +
+                                  ds.data_element(time_field).value)
+            if dt is not None:
+                return dt
+    w.warn('Cannot determine acquisition date time.', RuntimeWarning)
+    return None
+
+def get_time_order_key(ds):
+    ''' Return a key to sort dicoms by acquisition time, falling back to the
+        instance number, and then to the file order.
+
+        :param ds: dicom header information.
+        :type ds: dicom.dataset.FileDataset or OrderedDict
+        :returns: A tuple of ints.
+    '''
+    dt = get_acquisition_date_time(ds)
+    if dt is not None:
+        return (0, dt)
+    if 'InstanceNumber' in ds:
+        try:
+            return (1, int(ds.InstanceNumber))
+        except (TypeError, ValueError):
+            pass
+    return (2, 0)
     
 ''' 
 temp solution to sort the dicom list by last string of digit which has the same order as acq time.
@@ -113,12 +184,98 @@ DPm.1.2.840.113681.2863050707.1374648629.264.7180 predates DPm.1.2.840.113681.28
 '''
 def sort_func(s):
     return int(s.split('.')[-1])
+
+def get_required_tags( id_tag = None, use_date = False,
+                       use_modality = False, use_laterality = False,
+                       use_view = False, use_series = True, use_type = False,
+                       use_time_order = False ):
+    ''' Return the DICOM keywords that the getters need for a sortdicom run.
+
+        :returns: A list of DICOM keywords, or None if id_tag is not a known
+            keyword or tag, in which case the whole header should be read.
+    '''
+    tags = ['SpecificCharacterSet', 'AccessionNumber']
+    if id_tag:
+        try:
+            tags.append(parse_tag(id_tag))
+        except ValueError:
+            return None
+    if use_laterality:
+        tags += ['ImageLaterality', 'FrameLaterality', 'Laterality']
+    if use_view:
+        tags += ['ViewPosition']
+    if use_date:
+        tags += ['AcquisitionDate', 'StudyDate']
+    if use_modality:
+        tags += ['Modality']
+    if use_series:
+        tags += ['SeriesDescription', 'ProtocolName', 'SeriesNumber', 'InstanceNumber']
+    if use_type:
+        tags += ['PresentationIntentType']
+    if use_time_order:
+        tags += ['AcquisitionDateTime', 'AcquisitionDate', 'AcquisitionTime',
+                 'ContentDate', 'ContentTime', 'InstanceNumber']
+    return tags
+
+def resolve_name( new_name, seq_to_join, taken, next_index, delimiter = '_' ):
+    ''' Return a unique output name, appending _2, _3, ... to the joined
+        fields when new_name is already taken.
+
+        This gives the same names as scanning a list of taken names, but
+        keeps the taken names in a set and remembers the next index to try
+        for each base name, so a directory of n files costs O(n) instead of
+        O(n^2).
+
+        :param new_name: The preferred name.
+        :type new_name: str
+        :param seq_to_join: Fields joined with the index for a collision.
+        :type seq_to_join: list
+        :param taken: Names already assigned. The returned name is added.
+        :type taken: set
+        :param next_index: Next index to try per base name. Updated in place.
+        :type next_index: dict
+        :returns: A unique name in string.
+    '''
+    if new_name in taken:
+        base = delimiter.join(seq_to_join)
+        index = next_index.get(base, 2)
+        new_name = delimiter.join(seq_to_join + [str(index)])
+        while new_name in taken:
+            index += 1
+            new_name = delimiter.join(seq_to_join + [str(index)])
+        next_index[base] = index + 1
+    taken.add(new_name)
+    return new_name
     
     
 def sortdicom( idir, odir = None, mode='test',
                identifier = None, id_tag = None, use_date = False,
                use_modality = False, use_laterality = False,
-               use_view = False, use_series = True, use_type = False):
+               use_view = False, use_series = True, use_type = False,
+               threads = 4, journal = False, use_time_order = False, index_file = None,
+               force = False):
+    ''' Sort the dicoms in a directory and copy/move/link them to odir.
+
+        With use_time_order, name collisions are resolved in order of
+        acquisition time (falling back to instance number) instead of file
+        order, so the _N suffixes follow the acquisition. The sort keys are
+        taken during the single header pass.
+
+        With index_file (path to a header index, see header_index.py), headers are
+        read from the index when it is up to date with the file.
+
+        Only files with the DICM marker are sorted, or with force, also files
+        without the preamble (see discover_dicom.is_dicom).
+
+        With journal, files that are unchanged since a previous run in odir
+        with the same naming options keep their recorded names without
+        reading their headers, and only the files not applied yet are
+        moved/copied/linked.
+
+        :returns: The rename plan, a list of (input file, new name) tuples.
+            The new name is relative to odir without the .dcm extension, or
+            an empty string if the file could not be read.
+    '''
     print "Input directory is " + idir    
     if odir:
         print "Output directory is " + odir
@@ -126,14 +283,45 @@ def sortdicom( idir, odir = None, mode='test',
 #    print 'Use modality?' + str(use_modality)
     
     delimiter = '_'
-    names = []
+    taken = set()
+    next_index = {}
+    tags = get_required_tags(id_tag = id_tag, use_date = use_date,
+                             use_modality = use_modality, use_laterality = use_laterality,
+                             use_view = use_view, use_series = use_series, use_type = use_type,
+                             use_time_order = use_time_order)
     
-    files = glob(os.path.join(idir, "*"))
+    files = list(discover_dicom(idir, force = force))
     #files = sorted(glob(os.path.join(idir, "*")), key = sort_func)
     #files = sorted(glob(os.path.join(idir, "*")), key = os.path.getmtime) # this would sort the files by their modified time.
     print str(len(files)) + " files found for sorting"
+
+    naming = naming_hash(identifier = identifier, id_tag = id_tag, use_date = use_date,
+                         use_modality = use_modality, use_laterality = use_laterality,
+                         use_view = use_view, use_series = use_series, use_type = use_type,
+                         use_time_order = use_time_order)
+    conn = None
+    unchanged = {}
+    if journal and odir is not None and (mode != 'test' or os.path.exists(os.path.join(odir, _journal_name))):
+        conn = open_journal(odir)
+        entries = journal_entries(conn, idir)
+        odir_abs = os.path.abspath(odir)
+        for dcm in files:
+            entry = entries.get(os.path.abspath(dcm))
+            if entry is not None and entry[4] == naming and _is_unchanged(dcm, entry):
+                # reserve the recorded name so that new files cannot take it
+                name = os.path.relpath(entry[2], odir_abs)[:-len('.dcm')]
+                unchanged[dcm] = name
+                taken.add(name)
+        print str(len(unchanged)) + " files unchanged since the last run"
+
+    names = [''] * len(files)
+    # (sort key, position in files, new name, seq_to_join) to resolve after the header pass
+    to_resolve = []
     # idir contains dicoms to be sorted
-    for dcm in files:
+    for pos, dcm in enumerate(files):
+        if dcm in unchanged:
+            names[pos] = unchanged[dcm]
+            continue
         index = 1
         laterality = None
         view = None
@@ -146,10 +334,9 @@ def sortdicom( idir, odir = None, mode='test',
         
         # read dcm
         try:
-            ds = dicom.read_file(dcm, stop_before_pixels = True)
-        except IOError as e:
+            ds = read_header_cached(dcm, tags, index = index_file, force = force)
+        except (IOError, OSError) as e:
             print "I/O error({0}): {1}".format(e.errno, e.strerror)
-            names.append('')
             continue
             
         if use_laterality:
@@ -194,46 +381,283 @@ def sortdicom( idir, odir = None, mode='test',
 
         if series is not None:
             new_name = os.path.join(series, new_name)
+
+        key = get_time_order_key(ds) if use_time_order else None
+        to_resolve.append((key, pos, new_name, seq_to_join))
+
+    if use_time_order:
+        to_resolve.sort(key = lambda item: (item[0], item[1]))
+    for key, pos, new_name, seq_to_join in to_resolve:
+        names[pos] = resolve_name(new_name, seq_to_join, taken, next_index, delimiter)
         
-        while (new_name in names):
-            index += 1
-            new_name = delimiter.join(seq_to_join + [str(index)])
-            
-        names.append(new_name)
-        
-    ''' copy/move/create symbolic the files to odir
-        'test' to be default
-        'symbolic', 'move' and 'copy' to be other options '''
-        
-    # also check if the system allows symlinks.
-    if sys.platform == 'win32' and mode == 'symbolic':
-        print 'Symbolic links are not allowed on windows system. Use copy mode instead'
-        mode = 'copy'        
     if mode != 'test' and not os.path.exists(odir):
         print 'Creating output dir'
-        os.makedirs(odir)
+        _makedirs(odir)
     
-    for i, basename in enumerate(names):
-        print os.path.basename(files[i]) + ' -> ' + basename + '.dcm'
-        if basename is '':
+    plan = zip(files, names)
+    for src, basename in plan:
+        print os.path.basename(src) + ' -> ' + basename + '.dcm'
+
+    if mode != 'test':
+        apply_plan(get_outpaths(plan, odir), mode = mode, threads = threads, journal = conn, naming = naming)
+    if conn is not None:
+        conn.close()
+
+    return plan
+
+def get_outpaths( plan, odir ):
+    ''' Convert a rename plan from sortdicom into (input file, output file) pairs.
+
+        :param plan: A list of (input file, new name) tuples. Unreadable files
+            (empty new name) are dropped.
+        :type plan: list
+        :param odir: Output directory.
+        :type odir: str
+        :returns: A list of (input file, output file) tuples.
+    '''
+    return [(src, os.path.join(odir, basename + '.dcm')) for src, basename in plan if basename != '']
+
+def write_plan( outpaths, fname ):
+    ''' Write (input file, output file) pairs to a JSON or CSV plan file,
+        chosen by the extension of fname. Paths are stored as absolute paths.
+    '''
+    outpaths = [(os.path.abspath(src), os.path.abspath(dst)) for src, dst in outpaths]
+    if fname.lower().endswith('.json'):
+        import json
+        with open(fname, 'w') as f:
+            json.dump([{'source': src, 'destination': dst} for src, dst in outpaths], f, indent = 1)
+    else:
+        import csv
+        with open(fname, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['source', 'destination'])
+            writer.writerows(outpaths)
+
+def read_plan( fname ):
+    ''' Read a plan file written by write_plan.
+
+        :returns: A list of (input file, output file) tuples.
+    '''
+    if fname.lower().endswith('.json'):
+        import json
+        with open(fname, 'r') as f:
+            return [(d['source'], d['destination']) for d in json.load(f)]
+    else:
+        import csv
+        with open(fname, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader)
+            return [(row[0], row[1]) for row in reader]
+
+_journal_name = '.sortdicom_journal.sqlite'
+_journal_batch = 1000
+
+def open_journal( odir ):
+    ''' Open (or create) the sorting journal in an output directory.
+
+        The journal records the size, modification time and destination of
+        every input file handed to apply_plan, and whether it has been
+        applied. It lets a later run skip unchanged files and an interrupted
+        run resume where it stopped.
+
+        :param odir: Output directory.
+        :type odir: str
+        :returns: A sqlite3.Connection.
+    '''
+    import sqlite3
+    _makedirs(odir)
+    conn = sqlite3.connect(os.path.join(odir, _journal_name), timeout = 60)
+    conn.execute('CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, directory TEXT, '
+                 'size INTEGER, mtime REAL, destination TEXT, done INTEGER, naming TEXT)')
+    # journals written before the naming column
+    if 'naming' not in [row[1] for row in conn.execute('PRAGMA table_info(files)')]:
+        conn.execute('ALTER TABLE files ADD COLUMN naming TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+    conn.commit()
+    return conn
+
+def naming_hash( identifier = None, id_tag = None, use_date = False,
+                 use_modality = False, use_laterality = False,
+                 use_view = False, use_series = True, use_type = False,
+                 use_time_order = False, **kwargs ):
+    ''' Return a hash of the sortdicom options that the output names depend
+        on, recorded in the journal with each file. Other keyword arguments
+        of sortdicom are ignored.
+    '''
+    import hashlib
+    return hashlib.sha1(repr((identifier, id_tag, bool(use_date), bool(use_modality), bool(use_laterality),
+                              bool(use_view), bool(use_series), bool(use_type), bool(use_time_order)))).hexdigest()
+
+def journal_entries( conn, directory ):
+    ''' Return the journal entries of the input files in a directory.
+
+        :returns: A dict of absolute input file to (size, mtime, destination, done, naming).
+    '''
+    rows = conn.execute('SELECT source, size, mtime, destination, done, naming FROM files WHERE directory = ?',
+                        (os.path.abspath(directory),))
+    return dict((row[0], tuple(row[1:])) for row in rows)
+
+def _is_unchanged( src, entry ):
+    try:
+        st = os.stat(src)
+    except OSError:
+        return False
+    return (st.st_size, st.st_mtime) == (entry[0], entry[1])
+
+def journal_pending( conn, outpaths, mode ):
+    ''' Drop the (input file, output file) pairs that the journal shows as
+        already applied to an unchanged input file and an existing output.
+    '''
+    entries = {}
+    for directory in set(os.path.dirname(os.path.abspath(src)) for src, dst in outpaths):
+        entries.update(journal_entries(conn, directory))
+
+    pending = []
+    for src, dst in outpaths:
+        entry = entries.get(os.path.abspath(src))
+        if entry is not None and entry[2] == os.path.abspath(dst) and os.path.lexists(dst):
+            # a move interrupted before its done mark was committed
+            if mode == 'move' and not os.path.exists(src):
+                continue
+            if entry[3] and _is_unchanged(src, entry):
+                continue
+        pending.append((src, dst))
+    return pending
+
+def journal_record( conn, outpaths, naming = None ):
+    ''' Record (input file, output file) pairs as not yet applied, with the
+        naming_hash of the options that gave the output names (None if unknown).
+    '''
+    rows = []
+    for src, dst in outpaths:
+        if not os.path.exists(src):
             continue
-        if mode != 'test':
-            if use_series:
-                subodir, tail = os.path.split(os.path.join(odir, basename))
-                outpath = os.path.join(odir, basename + '.dcm')
-                if not os.path.exists(subodir):
-                    os.makedirs(subodir)
-            else:
-                outpath = os.path.join(odir, basename + '.dcm')
-            
-        if mode == 'move':
-            shutil.move(files[i], outpath)
-        elif mode == 'symbolic':
-            if os.path.islink(outpath):
-                os.unlink(outpath)
-            os.symlink(files[i], outpath)
-        elif mode == 'copy':
-            shutil.copyfile(files[i], outpath)
+        st = os.stat(src)
+        src = os.path.abspath(src)
+        rows.append((src, os.path.dirname(src), st.st_size, st.st_mtime, os.path.abspath(dst), naming))
+    conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, 0, ?)', rows)
+    conn.commit()
+
+def journal_naming( conn, outpaths, naming ):
+    ''' Record the naming_hash of the entries of (input file, output file)
+        pairs that are already in the journal with that output file.
+    '''
+    conn.executemany('UPDATE files SET naming = ? WHERE source = ? AND destination = ?',
+                     [(naming, os.path.abspath(src), os.path.abspath(dst)) for src, dst in outpaths])
+    conn.commit()
+
+def journal_done( conn, sources ):
+    ''' Mark input files as applied. '''
+    conn.executemany('UPDATE files SET done = 1 WHERE source = ?',
+                     [(os.path.abspath(src),) for src in sources])
+    conn.commit()
+
+def _same_device( src, dst_dir, devices ):
+    ''' Check whether src and dst_dir are on the same filesystem. The device of
+        each output directory is looked up once and cached in devices.
+    '''
+    if dst_dir not in devices:
+        devices[dst_dir] = os.stat(dst_dir).st_dev
+    return os.stat(src).st_dev == devices[dst_dir]
+
+def _hardlink( src, dst ):
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # hardlinks cannot cross filesystems
+        shutil.copyfile(src, dst)
+
+def _copyfile( pair ):
+    shutil.copyfile(*pair)
+    return pair
+
+def _apply_file( src, dst, mode, devices ):
+    if mode == 'move':
+        if _same_device(src, os.path.dirname(dst), devices):
+            os.rename(src, dst)
+        else:
+            shutil.move(src, dst)
+    elif mode == 'symbolic':
+        if os.path.islink(dst):
+            os.unlink(dst)
+        os.symlink(src, dst)
+    elif mode == 'hardlink':
+        _hardlink(src, dst)
+    elif mode == 'copy':
+        shutil.copyfile(src, dst)
+    return src, dst
+
+def apply_plan( outpaths, mode = 'symbolic', threads = 4, journal = None, naming = None ):
+    ''' Move/copy/link the input files to their output files.
+
+        All output directories are created in one batch first. A move within
+        one filesystem is a plain os.rename, and copies are done in a pool of
+        threads.
+
+        :param outpaths: A list of (input file, output file) tuples.
+        :type outpaths: list
+        :param mode: One of 'symbolic', 'hardlink', 'copy' or 'move'.
+        :type mode: str
+        :param threads: Number of threads for copy mode.
+        :type threads: int
+        :param journal: A journal from open_journal. Files already applied are
+            skipped and applied files are marked in batches.
+        :type journal: sqlite3.Connection
+        :param naming: naming_hash of the options that gave the output names,
+            recorded in the journal. None if unknown, e.g. for a plan file.
+        :type naming: str
+        :returns: Number of files applied.
+    '''
+    # also check if the system allows symlinks.
+    if sys.platform == 'win32' and mode == 'symbolic':
+        print 'Symbolic links are not allowed on windows system. Use copy mode instead'
+        mode = 'copy'
+
+    if journal is not None:
+        num_planned = len(outpaths)
+        pending = journal_pending(journal, outpaths, mode)
+        if num_planned > len(pending):
+            print "%d of %d files already applied according to the journal" % (num_planned - len(pending), num_planned)
+            if naming is not None:
+                # the files applied before got the same names with these options
+                journal_naming(journal, outpaths, naming)
+        outpaths = pending
+        journal_record(journal, outpaths, naming)
+
+    for subodir in sorted(set(os.path.dirname(dst) for src, dst in outpaths)):
+        if not os.path.isdir(subodir):
+            _makedirs(subodir)
+
+    pool = None
+    if mode == 'copy' and threads > 1 and len(outpaths) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        applied = pool.imap_unordered(_copyfile, outpaths)
+    else:
+        devices = {}
+        applied = (_apply_file(src, dst, mode, devices) for src, dst in outpaths)
+
+    num_applied = 0
+    done = []
+    try:
+        for src, dst in applied:
+            num_applied += 1
+            if journal is not None:
+                done.append(src)
+                if len(done) >= _journal_batch:
+                    journal_done(journal, done)
+                    done = []
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if journal is not None and done:
+            journal_done(journal, done)
+    return num_applied
         
 def main(argv = None):
     ''' parse a given directory and see if it contains 
@@ -243,7 +667,8 @@ def main(argv = None):
     if argv is None:
         argv = sys.argv[1:]
     # parse input from command line
-    args = create_parser().parse_args(argv)
+    parser = create_parser()
+    args = parser.parse_args(argv)
     
     import socket, time
 
@@ -256,25 +681,158 @@ def main(argv = None):
     print "Executing at", exe_time
     print "Executing in", exe_folder
     
+    if args.apply_plan is not None:
+        if args.mode == 'test':
+            parser.error('--apply requires a mode other than test.')
+        if args.journal and args.odir is None:
+            parser.error('--journal with --apply requires -o/--outputdir for the journal.')
+        outpaths = read_plan(args.apply_plan)
+        print "Applying %d files from %s in %s mode" % (len(outpaths), args.apply_plan, args.mode)
+        journal = open_journal(args.odir) if args.journal else None
+        num_applied = apply_plan(outpaths, mode = args.mode, threads = args.threads, journal = journal)
+        print "Applied %d files" % (num_applied)
+        return 0
+
+    if args.idir is None:
+        parser.error('-i/--inputdir is required unless --apply is given.')
+    if args.write_plan is not None and args.odir is None:
+        parser.error('--plan requires -o/--outputdir.')
+
     #print args
     if not os.path.isdir(args.idir):
         raise RuntimeError(args.idir + ' is not a valid directory.')
         
-    for dirpath, dirnames, filenames in os.walk(args.idir):
-        if dirnames == []:
-            root, subdirname = os.path.split(dirpath)
-            ##TMP#subodir = os.path.join(args.odir,subdirname)
-            
-            sortdicom( dirpath, odir = args.odir, mode = args.mode, 
+    # only plan the names when writing a plan file; it is applied later with --apply.
+    sort_kwargs = dict(odir = args.odir,
+                       mode = 'test' if args.write_plan is not None else args.mode,
                        identifier = args.subj, id_tag = args.tag_subj,
                        use_date = args.suffix_date,
                        use_modality = args.suffix_modality,
                        use_series = args.suffix_series,
                        use_laterality = args.suffix_laterality,
                        use_view = args.suffix_view,
-                       use_type = args.suffix_type)
+                       use_type = args.suffix_type,
+                       threads = args.threads,
+                       journal = args.journal,
+                       use_time_order = args.time_order,
+                       index_file = args.index,
+                       force = args.force)
+
+    status = 0
+    plan = []
+    if args.jobs > 1:
+        leaf_dirs = [dirpath for dirpath, dirnames, filenames in os.walk(args.idir) if dirnames == []]
+        plan, failed = sortdicom_parallel(leaf_dirs, sort_kwargs, jobs = args.jobs)
+        status = int(len(failed) > 0)
+    else:
+        for dirpath, dirnames, filenames in os.walk(args.idir):
+            if dirnames == []:
+                root, subdirname = os.path.split(dirpath)
+                ##TMP#subodir = os.path.join(args.odir,subdirname)
+                
+                plan += sortdicom( dirpath, **sort_kwargs )
+                print
+                print
+
+    if args.write_plan is not None:
+        outpaths = get_outpaths(plan, args.odir)
+        write_plan(outpaths, args.write_plan)
+        print "Wrote %d files to plan %s" % (len(outpaths), args.write_plan)
+
+    return status
+
+def _sortdicom_worker( job ):
+    ''' Run sortdicom on one leaf directory in a worker process.
+
+        The standard output of the run is captured so that the parent can print
+        it in the same order as a serial run.
+
+        :param job: A tuple of (directory, keyword arguments for sortdicom).
+        :returns: A tuple of (directory, rename plan, captured output, traceback or None).
+    '''
+    idir, kwargs = job
+    stdout = sys.stdout
+    sys.stdout = buf = StringIO()
+    plan = []
+    error = None
+    try:
+        plan = sortdicom(idir, **kwargs)
+    except:
+        error = ''.join(tb.format_exception(*sys.exc_info()))
+    finally:
+        sys.stdout = stdout
+    return idir, plan, buf.getvalue(), error
+
+def sortdicom_parallel( leaf_dirs, sort_kwargs, jobs = 2 ):
+    ''' Sort a list of leaf directories in a process pool.
+
+        Each directory is planned by sortdicom independently, so the names
+        (including the _N collision suffixes) are the same as a serial run.
+        The plans are applied by this process in input order, one directory
+        at a time, so that directories whose files map to the same output
+        files give the same result as a serial run. The per-directory output
+        is printed in input order.
+
+        :param leaf_dirs: Directories containing dicoms to be sorted.
+        :type leaf_dirs: list
+        :param sort_kwargs: Keyword arguments passed to sortdicom.
+        :type sort_kwargs: dict
+        :param jobs: Number of worker processes.
+        :type jobs: int
+        :returns: A tuple of (rename plan of all directories, failed directories).
+    '''
+    from multiprocessing import Pool
+
+    mode = sort_kwargs.get('mode', 'test')
+    odir = sort_kwargs.get('odir', None)
+    # the workers only plan the names
+    plan_kwargs = dict(sort_kwargs, mode = 'test')
+    journal = None
+    if mode != 'test':
+        if not os.path.exists(odir):
+            print 'Creating output dir'
+            _makedirs(odir)
+        if sort_kwargs.get('journal', False):
+            journal = open_journal(odir)
+
+    num_dirs = len(leaf_dirs)
+    plan = []
+    failed = []
+    pool = Pool(processes = jobs)
+    try:
+        results = pool.imap(_sortdicom_worker, [(d, plan_kwargs) for d in leaf_dirs])
+        for i, (idir, dir_plan, output, error) in enumerate(results):
+            sys.stdout.write(output)
+            plan += dir_plan
+            if error is None and mode != 'test':
+                try:
+                    apply_plan(get_outpaths(dir_plan, odir), mode = mode,
+                               threads = sort_kwargs.get('threads', 4), journal = journal,
+                               naming = naming_hash(**sort_kwargs))
+                except:
+                    error = ''.join(tb.format_exception(*sys.exc_info()))
+            if error is None:
+                print "[%d/%d] Done: %s" % (i+1, num_dirs, idir)
+            else:
+                print "[%d/%d] Failed: %s" % (i+1, num_dirs, idir)
+                sys.stderr.write(error)
+                failed.append(idir)
             print
             print
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if journal is not None:
+            journal.close()
+
+    if failed:
+        print "%d of %d directories failed:" % (len(failed), num_dirs)
+        for idir in failed:
+            print "    " + idir
+    return plan, failed
             
 def create_parser():
     import argparse
@@ -286,11 +844,11 @@ def create_parser():
                                      description = 'Sort dicom images by laterality, view position and other identifiers. This program is designed for breast mammograms. CBIG output convention (Default): ID_LATERALITY_VIEW_#.dcm. MSKCC output convention: ID_LATERALITY_MODALITY_VIEW_DATE_#.dcm.')
     # Required
     parser.add_argument('-i', '--inputdir',
-                        required = True,
                         dest = 'idir',
                         action = 'store',
+                        default = None,
                         type = str,
-                        help = 'Input directory.')                          
+                        help = 'Input directory. Required unless --apply is given.')                          
 
     ## optional
     parser.add_argument('-o', '--outputdir',
@@ -303,9 +861,9 @@ def create_parser():
                         dest = 'mode',
                         action = 'store',
                         default = 'test',
-                        choices = ['test', 'symbolic', 'move', 'copy'],
+                        choices = ['test', 'symbolic', 'hardlink', 'move', 'copy'],
                         type = str,
-                        help = 'There are four ways to create sorted filenames: test (default): dry-run on the data and display the result on standard output; symbolic: create soft/symbolic links at output_dir. (overwrite existing links); copy: create a new copy of files in output_dir; move: rename the original dicoms and move to output_dir. Creating symbolic link is highly recommended to reduce filesystem IO during runtime and also to preserve the linkage between unsorted files to sorted files.')                      
+                        help = 'There are five ways to create sorted filenames: test (default): dry-run on the data and display the result on standard output; symbolic: create soft/symbolic links at output_dir. (overwrite existing links); hardlink: create hard links at output_dir, falling back to a copy across filesystems (overwrite existing files); copy: create a new copy of files in output_dir; move: rename the original dicoms and move to output_dir. Creating symbolic link is highly recommended to reduce filesystem IO during runtime and also to preserve the linkage between unsorted files to sorted files.')                      
     parser.add_argument('-s', '--subject_id',
                         dest = 'subj',
                         action = 'store',
@@ -348,6 +906,51 @@ def create_parser():
                         action = 'store_true',
                         default = False,
                         help = 'A flag to add view position in the output suffix. Default: off.')
+    parser.add_argument('--time_order',
+                        dest = 'time_order',
+                        action = 'store_true',
+                        default = False,
+                        help = 'A flag to number duplicated names in order of acquisition date time (AcquisitionDateTime, AcquisitionDate/Time or ContentDate/Time, then InstanceNumber) instead of file order. Default: off.')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        action = 'store',
+                        default = 1,
+                        type = int,
+                        help = 'Number of processes to sort leaf directories in parallel. Output is identical to a serial run. Default: 1.')
+    parser.add_argument('-t', '--threads',
+                        dest = 'threads',
+                        action = 'store',
+                        default = 4,
+                        type = int,
+                        help = 'Number of threads to copy files in copy mode. Default: 4.')
+    parser.add_argument('--plan',
+                        dest = 'write_plan',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'Only plan the sorting and write the input and output files to this plan file (.json or .csv) instead of touching any file. Requires -o. Apply it later with --apply.')
+    parser.add_argument('--apply',
+                        dest = 'apply_plan',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'Apply a plan file written by --plan with the given mode. No dicom is read.')
+    parser.add_argument('-x', '--index',
+                        dest = 'index',
+                        action = 'store',
+                        default = None,
+                        type = str,
+                        help = 'Header index file (see header_index.py). Headers are read from the index when it is up to date with the file, and added to it otherwise. Default: none.')
+    parser.add_argument('--force',
+                        dest = 'force',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Also sort files without the 128-byte preamble and DICM marker. Default: off.')
+    parser.add_argument('--journal',
+                        dest = 'journal',
+                        action = 'store_true',
+                        default = False,
+                        help = 'Keep a journal (%s) in the output directory. Files unchanged since the last run keep their names without being read again, and an interrupted copy/move/link resumes where it stopped. Default: off.' % _journal_name)
     return parser
 
 